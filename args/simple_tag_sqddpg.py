@@ -14,7 +14,7 @@ model_name = 'sqddpg'
 scenario_name = 'simple_tag'
 
 '''define the special property'''
-# sqddpgArgs = namedtuple( 'sqddpgArgs', ['sample_size'] )
+# sqddpgArgs = namedtuple( 'sqddpgArgs', ['sample_size', 'shapley_mode', 'permutation_pool_size', 'permutation_pool_refresh', 'coalition_sampling', 'target_std_error', 'max_sample_size', 'dedup_coalitions'] ), the trailing fields are optional
 aux_args = AuxArgs[model_name](1)
 alias = ''
 
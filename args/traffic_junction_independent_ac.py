@@ -57,7 +57,8 @@ args = Args(model_name=model_name,
             epsilon_softmax=False,
             online=True,
             reward_record_type='episode_mean_step',
-            shared_parameters=False
+            shared_parameters=False,
+            alive_mask=True
            )
 
 args = MergeArgs(*(args+aux_args))
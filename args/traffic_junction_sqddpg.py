@@ -10,7 +10,7 @@ from environments.traffic_junction_env import TrafficJunctionEnv
 model_name = 'sqddpg'
 
 '''define the special property'''
-# sqddpgArgs = namedtuple( 'sqddpgArgs', ['sample_size'] )
+# sqddpgArgs = namedtuple( 'sqddpgArgs', ['sample_size', 'shapley_mode', 'permutation_pool_size', 'permutation_pool_refresh', 'coalition_sampling', 'target_std_error', 'max_sample_size', 'dedup_coalitions'] ), the trailing fields are optional
 aux_args = AuxArgs[model_name](1) # sqddpg
 alias = '_medium'
 
@@ -57,7 +57,8 @@ args = Args(model_name=model_name,
             epsilon_softmax=False,
             online=True,
             reward_record_type='episode_mean_step',
-            shared_parameters=False
+            shared_parameters=False,
+            alive_mask=True
            )
 
 args = MergeArgs(*(args+aux_args))
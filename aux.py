@@ -4,6 +4,7 @@ from models.sqddpg import *
 from models.independent_ac import *
 from models.independent_ddpg import *
 from models.coma_fc import *
+from models.mfac import *
 
 
 
@@ -11,19 +12,32 @@ maddpgArgs = namedtuple( 'maddpgArgs', [] )
 
 randomArgs = namedtuple( 'randomArgs', [] )
 
-sqddpgArgs = namedtuple( 'sqddpgArgs', ['sample_size'] )
+sqddpgArgs = namedtuple( 'sqddpgArgs', ['sample_size',
+                                         'shapley_mode', # 'sample'<-monte carlo over sample_size permutations/'exact'<-all coalitions (attention critic)
+                                         'permutation_pool_size', # 0<-sample fresh permutations every call/int<-size of a precomputed pool
+                                         'permutation_pool_refresh', # calls of the sampler between two refreshes of the pool
+                                         'coalition_sampling', # 'random'/'antithetic'<-pairs of reversed permutations/'stratified'<-cyclic shifts of the positions
+                                         'target_std_error', # None<-fixed sample_size/float<-adapt sample_size to this standard error of the shapley values
+                                         'max_sample_size', # None<-4*sample_size/int<-upper bound of the adaptive sample_size
+                                         'dedup_coalitions' # boolean, evaluate every distinct coalition input of a state once
+                                        ]
+                       )
+sqddpgArgs.__new__.__defaults__ = ('sample', 0, 100, 'random', None, None, False)
 
 independentArgs = namedtuple( 'independentArgs', [] )
 
 comafcArgs = namedtuple( 'comafcArgs', [] )
 
+mfacArgs = namedtuple( 'mfacArgs', [] )
+
 
 
 Model = dict(maddpg=MADDPG,
              sqddpg=SQDDPG,
              independent_ac=IndependentAC,
              independent_ddpg=IndependentDDPG,
-             coma_fc=COMAFC
+             coma_fc=COMAFC,
+             mfac=MFAC
             )
 
 
@@ -32,7 +46,8 @@ AuxArgs = dict(maddpg=maddpgArgs,
                sqddpg=sqddpgArgs,
                independent_ac=independentArgs,
                independent_ddpg=independentArgs,
-               coma_fc=comafcArgs
+               coma_fc=comafcArgs,
+               mfac=mfacArgs
               )
 
 
@@ -41,7 +56,8 @@ Strategy=dict(maddpg='pg',
               sqddpg='pg',
               independent_ac='pg',
               independent_ddpg='pg',
-              coma_fc='pg'
+              coma_fc='pg',
+              mfac='pg'
              )
 
 
@@ -79,6 +95,25 @@ Args = namedtuple('Args', ['model_name',
                            'epsilon_softmax',
                            'online',
                            'reward_record_type',
-                           'shared_parameters' # boolean
+                           'shared_parameters', # boolean
+                           'num_threads', # None<-calibrate at startup/int<-fixed
+                           'num_interop_threads', # None<-1 on cpu/int<-fixed
+                           'env_num', # number of environment copies stepped by one batched policy forward
+                           'actor_num', # 0<-rollout in the learner/int<-number of rollout worker processes
+                           'weight_sync_freq', # policy updates between two weight broadcasts to the workers
+                           'seed', # None<-unseeded/int<-seed of random, numpy and torch
+                           'data_parallel', # boolean, all-reduce the gradients of the learners started by torchrun
+                           'async_learner', # boolean, run the updates on a learner thread beside the rollout
+                           'update_to_data_ratio', # None<-1/behaviour_update_freq/float<-policy updates per environment step
+                           'n_step', # 1<-one-step td targets/int<-n-step returns over the latest batch_size steps (on-policy models)
+                           'target_cache', # boolean, cache the target next state values of the replay slots until the next target update
+                           'critic_type', # 'mlp'<-a critic per agent on the joint input/'attention'<-one critic attending over the agents
+                           'attention_heads', # heads of the attention critic, hid_size is divided among them
+                           'agent_id_embedding', # 0<-none/int<-size of a learned agent id embedding fed to the shared policy
+                           'alive_mask', # boolean, evaluate and train only the agents alive in the environment, e.g. the cars of traffic junction
+                           'gae_lambda' # None<-n_step targets/float<-lambda-returns of the generalized advantage estimation (on-policy models)
                           ]
                  )
+
+# the trailing fields are optional so that the existing argument files stay valid
+Args.__new__.__defaults__ = (None, None, 1, 0, 1, None, False, False, None, 1, False, 'mlp', 4, 0, False, None)
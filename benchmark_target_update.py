@@ -0,0 +1,64 @@
+import argparse
+from collections import namedtuple
+import time
+import torch
+from aux import Args, AuxArgs, Model
+
+
+
+parser = argparse.ArgumentParser(description='Time the target network update against the number of parameters.')
+parser.add_argument('--model', type=str, default='maddpg', help='Please input the model name, e.g. maddpg or sqddpg.')
+parser.add_argument('--agent-num', type=int, nargs='*', default=[3, 10, 30], help='Please input the numbers of agents to try.')
+parser.add_argument('--hid-size', type=int, nargs='*', default=[32, 128, 512], help='Please input the hidden sizes to try.')
+parser.add_argument('--target-lr', type=float, default=0.1, help='Please input the soft update rate, 1 copies the parameters.')
+parser.add_argument('--iterations', type=int, default=100, help='Please input the number of timed updates.')
+argv = parser.parse_args()
+
+
+
+def make_args(agent_num, hid_size):
+    '''
+    the arguments merged with the special ones of the model as in the argument files, sqddpg samples 5 coalitions
+    '''
+    MergeArgs = namedtuple('MergeArgs', Args._fields+AuxArgs[argv.model]._fields)
+    aux_args = AuxArgs[argv.model](5) if argv.model == 'sqddpg' else AuxArgs[argv.model]()
+    args = Args(model_name=argv.model, agent_num=agent_num, hid_size=hid_size, obs_size=18, continuous=False, action_dim=5,
+                init_std=0.1, policy_lrate=1e-4, value_lrate=1e-3, max_steps=200, batch_size=32, gamma=0.9,
+                normalize_advantages=False, entr=1e-3, entr_inc=0.0, action_num=5, q_func=True, train_episodes_num=1,
+                replay=True, replay_buffer_size=1e4, replay_warmup=0, cuda=False, grad_clip=True, save_model_freq=10,
+                target=True, target_lr=argv.target_lr, behaviour_update_freq=100, critic_update_times=10,
+                target_update_freq=200, gumbel_softmax=True, epsilon_softmax=False, online=True,
+                reward_record_type='episode_mean_step', shared_parameters=False)
+    return MergeArgs(*(args+aux_args))
+
+def state_dict_update(net):
+    '''
+    the update before the fused version, the state dicts are rebuilt for every parameter
+    '''
+    for name, param in net.target_net.action_dicts.state_dict().items():
+        update_params = (1 - net.args.target_lr) * param + net.args.target_lr * net.action_dicts.state_dict()[name]
+        net.target_net.action_dicts.state_dict()[name].copy_(update_params)
+    for name, param in net.target_net.value_dicts.state_dict().items():
+        update_params = (1 - net.args.target_lr) * param + net.args.target_lr * net.value_dicts.state_dict()[name]
+        net.target_net.value_dicts.state_dict()[name].copy_(update_params)
+
+def timing(update, net):
+    update(net)
+    start = time.time()
+    for _ in range(argv.iterations):
+        update(net)
+    return (time.time() - start) / argv.iterations
+
+
+
+if __name__ == '__main__':
+    print ('{:>6s} {:>6s} {:>12s} {:>16s} {:>12s} {:>8s}'.format('Agents', 'Hidden', 'Parameters', 'State dict (ms)', 'Fused (ms)', 'Speedup'))
+    for agent_num in argv.agent_num:
+        for hid_size in argv.hid_size:
+            args = make_args(agent_num, hid_size)
+            net = Model[argv.model](args, Model[argv.model](args))
+            with torch.no_grad():
+                params = sum(param.numel() for param in net.target_params()[0])
+                old = timing(state_dict_update, net)
+                new = timing(lambda net: net.update_target(), net)
+            print ('{:6d} {:6d} {:12d} {:16.4f} {:12.4f} {:8.2f}'.format(agent_num, hid_size, params, old*1e3, new*1e3, old/new))
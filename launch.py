@@ -0,0 +1,130 @@
+import argparse
+import ast
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+
+parser = argparse.ArgumentParser(description='Launch several training runs in parallel.')
+parser.add_argument('--spec', type=str, default=None, help='Please input a json file with a list of runs, e.g. [{"exp": "simple_spread_sqddpg", "seed": 0, "overrides": {"hid_size": 64}}].')
+parser.add_argument('--exp', type=str, nargs='*', default=[], help='Please input the names of the argument files under ./args.')
+parser.add_argument('--seeds', type=int, nargs='*', default=[0], help='Please input the seeds to run for every argument file.')
+parser.add_argument('--set', type=str, nargs='*', default=[], help='Please input the overrides of the arguments, e.g. hid_size=64.')
+parser.add_argument('--save-path', type=str, default='./', help='Please input the directory of saving model.')
+parser.add_argument('--cores-per-run', type=int, default=1, help='Please input the number of cores pinned to every run.')
+parser.add_argument('--max-parallel', type=int, default=None, help='Please input the maximum number of concurrent runs (default: cores/cores-per-run).')
+argv = parser.parse_args()
+
+
+
+def get_runs(argv):
+    runs = []
+    if argv.spec is not None:
+        with open(argv.spec) as file:
+            runs.extend(json.load(file))
+    overrides = dict()
+    for kv in argv.set:
+        key, value = kv.split('=', 1)
+        try:
+            overrides[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            overrides[key] = value
+    for exp, seed in itertools.product(argv.exp, argv.seeds):
+        runs.append(dict(exp=exp, seed=seed, overrides=overrides))
+    for run in runs:
+        run.setdefault('seed', None)
+        run.setdefault('overrides', dict())
+        tag = ''.join('_{}{}'.format(k, v) for k, v in sorted(run['overrides'].items()))
+        run['log_name'] = run['exp'] + re.sub(r'[^\w.-]', '', tag) + ('' if run['seed'] is None else '_seed{}'.format(run['seed']))
+    return runs
+
+def write_arguments(run, path):
+    '''
+    generate the private argument file of a run, the overrides are python literals
+    '''
+    with open('./args/{}.py'.format(run['exp'])) as file:
+        source = file.read()
+    replace = ['{}={!r}'.format(k, v) for k, v in sorted(run['overrides'].items())]
+    if run['seed'] is not None:
+        replace.append('seed={!r}'.format(run['seed']))
+    with open(path, 'w') as file:
+        file.write(source+'\n\n')
+        file.write('# generated by launch.py\n')
+        file.write('args = args._replace({})\n'.format(', '.join(replace)))
+        file.write('log_name = {!r}\n'.format(run['log_name']))
+
+def get_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def start(run, cores, save_path):
+    log_dir = save_path+'model_save/'+run['log_name']
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    write_arguments(run, log_dir+'/arguments.py')
+    run['log_dir'] = log_dir
+    env = dict(os.environ)
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        env[var] = str(len(cores))
+    preexec_fn = (lambda: os.sched_setaffinity(0, cores)) if hasattr(os, 'sched_setaffinity') else None
+    run['out'] = open(log_dir+'/exp.out', 'w')
+    run['start'] = time.time()
+    run['process'] = subprocess.Popen([sys.executable, '-u', 'train.py', '--save-path', save_path, '--arguments', log_dir+'/arguments.py'],
+                                      stdout=run['out'], stderr=subprocess.STDOUT, env=env, preexec_fn=preexec_fn)
+    with open(log_dir+'/exp.pid', 'w') as file:
+        file.write(str(run['process'].pid))
+    print ('Run {} starts on cores {}.'.format(run['log_name'], cores))
+
+def summarize(run):
+    episodes, reward = 0, float('nan')
+    with open(run['log_dir']+'/exp.out') as file:
+        for line in file:
+            match = re.match(r'Episode:\s*(\d+), Mean Reward:\s*([-\d.naif]+)', line)
+            if match:
+                episodes, reward = int(match.group(1)), float(match.group(2))
+    return dict(name=run['log_name'],
+                status=run['process'].returncode,
+                time=run['end']-run['start'],
+                episodes=episodes,
+                episodes_per_second=episodes/max(run['end']-run['start'], 1e-8),
+                mean_reward=reward
+               )
+
+
+
+if __name__ == '__main__':
+    save_path = argv.save_path if argv.save_path.endswith('/') else argv.save_path+'/'
+    runs = get_runs(argv)
+    cores = get_cores()
+    slot_num = max(1, len(cores)//argv.cores_per_run)
+    if argv.max_parallel is not None:
+        slot_num = min(slot_num, argv.max_parallel)
+    free_slots = [cores[i*argv.cores_per_run:(i+1)*argv.cores_per_run] or cores for i in range(slot_num)]
+    pending, running, results = list(runs), [], []
+    while pending or running:
+        while pending and free_slots:
+            run = pending.pop(0)
+            run['slot'] = free_slots.pop(0)
+            start(run, run['slot'], save_path)
+            running.append(run)
+        time.sleep(1)
+        for run in list(running):
+            if run['process'].poll() is not None:
+                run['end'] = time.time()
+                run['out'].close()
+                running.remove(run)
+                free_slots.append(run['slot'])
+                results.append(summarize(run))
+                print ('Run {} is finished with status {}.'.format(run['log_name'], run['process'].returncode))
+    print ('\n'+'='*10+' SUMMARY '+'='*10)
+    print ('{:50s} {:>6s} {:>10s} {:>8s} {:>10s} {:>12s}'.format('Run', 'Status', 'Time(s)', 'Episodes', 'Episodes/s', 'Mean Reward'))
+    for result in sorted(results, key=lambda r: r['name']):
+        print ('{name:50s} {status:6d} {time:10.1f} {episodes:8d} {episodes_per_second:10.3f} {mean_reward:12.4f}'.format(**result))
+    with open(save_path+'model_save/launch_summary.json', 'w') as file:
+        json.dump(results, file, indent=2)
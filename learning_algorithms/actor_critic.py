@@ -18,31 +18,30 @@ class ActorCritic(ReinforcementLearning):
         n = self.args.agent_num
         # collect the transition data
         rewards, last_step, done, actions, state, next_state = behaviour_net.unpack_data(batch)
+        alive_mask, next_alive_mask = behaviour_net.unpack_alive_masks(batch)
+        info, next_info = {'alive_mask': alive_mask}, {'alive_mask': next_alive_mask}
         # construct the computational graph
-        action_out = behaviour_net.policy(state)
-        values = behaviour_net.value(state, actions)
+        action_out = behaviour_net.policy(state, info=info)
+        values = behaviour_net.value(state, actions, info=info)
         if self.args.q_func:
             values = torch.sum(values*actions, dim=-1)
         values = values.contiguous().view(-1, n)
         if target_net == None:
-            next_action_out = behaviour_net.policy(next_state)
+            next_action_out = behaviour_net.policy(next_state, info=next_info)
         else:
-            next_action_out = target_net.policy(next_state)
+            next_action_out = target_net.policy(next_state, info=next_info)
         next_actions = select_action(self.args, next_action_out, status='train')
-        next_values = behaviour_net.value(next_state, next_actions)
+        next_values = behaviour_net.value(next_state, next_actions, info=next_info)
         if self.args.q_func:
             next_values = torch.sum(next_values*next_actions, dim=-1)
         next_values = next_values.contiguous().view(-1, n)
-        returns = cuda_wrapper(torch.zeros((batch_size, n), dtype=torch.float), self.cuda_)
+        if next_alive_mask is not None:
+            # the cars that leave have no next value
+            next_values = next_values * next_alive_mask
         # calculate the advantages
         assert values.size() == next_values.size()
+        returns = compute_returns(self.args, rewards, last_step, done, values, next_values)
         assert returns.size() == values.size()
-        for i in reversed(range(rewards.size(0))):
-            if last_step[i]:
-                next_return = 0 if done[i] else next_values[i].detach()
-            else:
-                next_return = next_values[i].detach()
-            returns[i] = rewards[i] + self.args.gamma * next_return
         deltas = returns - values
         advantages = values.detach()
         # advantages = advantages.contiguous().view(-1, 1)
@@ -52,6 +51,6 @@ class ActorCritic(ReinforcementLearning):
         log_prob_a = multinomials_log_density(actions, action_out).contiguous().view(-1,n)
         assert log_prob_a.size() == advantages.size()
         action_loss = -advantages * log_prob_a
-        action_loss = action_loss.mean(dim=0)
-        value_loss = deltas.pow(2).mean(dim=0)
+        action_loss = masked_mean(action_loss, alive_mask)
+        value_loss = masked_mean(deltas.pow(2), alive_mask)
         return action_loss, value_loss, action_out
@@ -11,37 +11,40 @@ class DDPG(ReinforcementLearning):
     def __call__(self, batch, behaviour_net, target_net):
         return self.get_loss(batch, behaviour_net, target_net)
 
+    def target_next_values(self, next_state, next_alive_mask, target_net):
+        next_info = {'alive_mask': next_alive_mask}
+        next_action_out = target_net.policy(next_state, info=next_info)
+        next_actions_ = select_action(self.args, next_action_out, status='train', exploration=False)
+        return target_net.value(next_state, next_actions_.detach(), info=next_info).contiguous().view(-1, self.args.agent_num)
+
     def get_loss(self, batch, behaviour_net, target_net):
         # TODO: fix policy params update
         batch_size = len(batch.state)
         n = self.args.agent_num
         # collect the transition data
         rewards, last_step, done, actions, state, next_state = behaviour_net.unpack_data(batch)
+        alive_mask, next_alive_mask = behaviour_net.unpack_alive_masks(batch)
+        info = {'alive_mask': alive_mask}
         # construct the computational graph
         # do the argmax action on the action loss
-        action_out = behaviour_net.policy(state)
+        action_out = behaviour_net.policy(state, info=info)
         actions_ = select_action(self.args, action_out, status='train', exploration=False)
-        values_ = behaviour_net.value(state, actions_).contiguous().view(-1, n)
+        values_ = behaviour_net.value(state, actions_, info=info).contiguous().view(-1, n)
         # do the exploration action on the value loss
-        values = behaviour_net.value(state, actions).contiguous().view(-1, n)
+        values = behaviour_net.value(state, actions, info=info).contiguous().view(-1, n)
         # do the argmax action on the next value loss
-        next_action_out = target_net.policy(next_state)
-        next_actions_ = select_action(self.args, next_action_out, status='train', exploration=False)
-        next_values_ = target_net.value(next_state, next_actions_.detach()).contiguous().view(-1, n)
-        returns = cuda_wrapper(torch.zeros((batch_size, n), dtype=torch.float), self.cuda_)
+        next_values_ = behaviour_net.target_values(next_state, lambda next_state, next_alive_mask: self.target_next_values(next_state, next_alive_mask, target_net), next_alive_mask)
+        if next_alive_mask is not None:
+            # the cars that leave have no next value
+            next_values_ = next_values_ * next_alive_mask
         assert values_.size() == next_values_.size()
+        returns = td_target(rewards, last_step, done, next_values_, self.args.gamma)
         assert returns.size() == values.size()
-        for i in reversed(range(rewards.size(0))):
-            if last_step[i]:
-                next_return = 0 if done[i] else next_values_[i].detach()
-            else:
-                next_return = next_values_[i].detach()
-            returns[i] = rewards[i] + self.args.gamma * next_return
         deltas = returns - values
         advantages = values_
         if self.args.normalize_advantages:
             advantages = batchnorm(advantages)
         action_loss = -advantages
-        action_loss = action_loss.mean(dim=0)
-        value_loss = deltas.pow(2).mean(dim=0)
+        action_loss = masked_mean(action_loss, alive_mask)
+        value_loss = masked_mean(deltas.pow(2), alive_mask)
         return action_loss, value_loss, action_out
@@ -3,6 +3,7 @@ import torch.nn as nn
 import numpy as np
 from utilities.util import *
 from models.model import Model
+from models.layers import MultiAgentLinear
 from collections import namedtuple
 
 
@@ -16,116 +17,83 @@ class COMAFC(Model):
         if target_net != None:
             self.target_net = target_net
             self.reload_params_to_target()
-        self.Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state', 'done', 'last_step'))
-
-    def construct_policy_net(self):
-        action_dicts = []
-        if self.args.shared_parameters:
-            l1 = nn.Linear(self.obs_dim, self.hid_dim)
-            l2 = nn.Linear(self.hid_dim, self.hid_dim)
-            a = nn.Linear(self.hid_dim, self.act_dim)
-            for i in range(self.n_):
-                action_dicts.append(nn.ModuleDict( {'layer_1': l1,\
-                                                    'layer_2': l2,\
-                                                    'action_head': a
-                                                    }
-                                                 )
-                                   )
-        else:
-            for i in range(self.n_):
-                action_dicts.append(nn.ModuleDict( {'layer_1': nn.Linear(self.obs_dim, self.hid_dim),\
-                                                    'layer_2': nn.Linear(self.hid_dim, self.hid_dim),\
-                                                    'action_head': nn.Linear(self.hid_dim, self.act_dim)
-                                                    }
-                                                  )
-                                   )
-        self.action_dicts = nn.ModuleList(action_dicts)
+        self.Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state', 'done', 'last_step', 'alive_mask', 'next_alive_mask'), defaults=(None, None))
+        # the indices of the other agents in ascending order for every agent, shape = (n, n-1)
+        self.other_agents = cuda_wrapper(torch.tensor([[j for j in range(self.n_) if j != i] for i in range(self.n_)], dtype=torch.long), self.cuda_)
+        # the attention critic of every agent sees the actions of the other agents, shape = (1, 1, n, n)
+        self.other_agents_member = cuda_wrapper(1 - torch.eye(self.n_).view(1, 1, self.n_, self.n_), self.cuda_)
 
     def construct_value_net(self):
-        value_dicts = []
-        if self.args.shared_parameters:
-            l1 = nn.Linear((self.n_+1)*self.obs_dim+(self.n_-1)*self.act_dim, self.hid_dim)
-            l2 = nn.Linear(self.hid_dim, self.hid_dim)
-            v = nn.Linear(self.hid_dim, self.act_dim)
-            for i in range(self.n_):
-                value_dicts.append(nn.ModuleDict( {'layer_1': l1,\
-                                                   'layer_2': l2,\
-                                                   'value_head': v
-                                                  }
-                                                )
-                                  )
-        else:
-            for i in range(self.n_):
-                value_dicts.append(nn.ModuleDict( {'layer_1': nn.Linear((self.n_+1)*self.obs_dim+(self.n_-1)*self.act_dim, self.hid_dim),\
-                                                   'layer_2': nn.Linear(self.hid_dim, self.hid_dim),\
-                                                   'value_head': nn.Linear(self.hid_dim, self.act_dim)
-                                                  }
-                                                )
-                                  )
-        self.value_dicts = nn.ModuleList(value_dicts)
+        if self.args.critic_type == 'attention':
+            self.construct_attention_value_net(self.act_dim)
+            return
+        shared = self.args.shared_parameters
+        self.value_dicts = nn.ModuleDict( {'layer_1': MultiAgentLinear(self.n_, (self.n_+1)*self.obs_dim+(self.n_-1)*self.act_dim, self.hid_dim, shared),\
+                                           'layer_2': MultiAgentLinear(self.n_, self.hid_dim, self.hid_dim, shared),\
+                                           'value_head': MultiAgentLinear(self.n_, self.hid_dim, self.act_dim, shared)
+                                          }
+                                        )
 
     def construct_model(self):
         self.construct_value_net()
         self.construct_policy_net()
 
-    def policy(self, obs, schedule=None, last_act=None, last_hid=None, info={}, stat={}):
-        actions = []
-        for i in range(self.n_):
-            h = torch.relu( self.action_dicts[i]['layer_1'](obs[:, i, :]) )
-            h = torch.relu( self.action_dicts[i]['layer_2'](h) )
-            a = self.action_dicts[i]['action_head'](h)
-            actions.append(a)
-        actions = torch.stack(actions, dim=1)
-        return actions
-
-    def value(self, obs, act):
+    def value(self, obs, act, info={}):
+        packing = self.get_agent_mask(info)
+        if packing is not None:
+            # the dead agents take no action
+            act = act * packing.mask.unsqueeze(-1)
+        if self.args.critic_type == 'attention':
+            return self.attention_value(obs, act.unsqueeze(1), self.other_agents_member)[:, 0, 0] # shape = (b, n, a)
         batch_size = obs.size(0)
-        obs_own = obs.clone()
-        obs = obs.unsqueeze(1).expand(batch_size, self.n_, self.n_, self.obs_dim) # shape = (b, n, o) -> (b, 1, n, o) -> (b, n, n, o)
-        obs = obs.contiguous().view(batch_size, self.n_, -1) # shape = (b, n, o*n)
-        inp = torch.cat((obs, obs_own), dim=-1) # shape = (b, n, o*n+o)
-        values = []
-        for i in range(self.n_):
-            # other people actions
-            act_other = torch.cat((act[:,:i,:].view(batch_size,-1),act[:,i+1:,:].view(batch_size,-1)),dim=-1)
-            h = torch.relu( self.value_dicts[i]['layer_1'](torch.cat((inp[:, i, :], act_other),dim=-1)) )
-            h = torch.relu( self.value_dicts[i]['layer_2'](h) )
-            v = self.value_dicts[i]['value_head'](h)
-            values.append(v)
-        values = torch.stack(values, dim=1)
-        return values
+        # layer_1 is split into the joint observation shared by all agents, the own observation and the other people actions,
+        # so that the joint observation is never expanded per agent
+        joint_obs_features = slice(0, self.n_*self.obs_dim)
+        own_obs_features = slice(self.n_*self.obs_dim, (self.n_+1)*self.obs_dim)
+        act_other_features = slice((self.n_+1)*self.obs_dim, (self.n_+1)*self.obs_dim+(self.n_-1)*self.act_dim)
+        # other people actions
+        act_other = act[:, self.other_agents, :].contiguous().view(batch_size, self.n_, -1) # shape = (b, n, n-1, a) -> (b, n, (n-1)*a)
+        h = self.value_dicts['layer_1'].forward_shared_input(obs.contiguous().view(batch_size, -1), features=joint_obs_features) # shape = (b, n, h)
+        if packing is not None:
+            # only the critics of the alive agents are evaluated after the joint observation
+            h, obs, act_other = packing.pack(h), packing.pack(obs), packing.pack(act_other) # shape = (N, ...)
+        h = h + self.value_dicts['layer_1'](obs, features=own_obs_features, bias=False, packing=packing)
+        h = h + self.value_dicts['layer_1'](act_other, features=act_other_features, bias=False, packing=packing)
+        h = torch.relu(h)
+        h = torch.relu( self.value_dicts['layer_2'](h, packing=packing) )
+        values = self.value_dicts['value_head'](h, packing=packing)
+        return values if packing is None else packing.unpack(values)
 
 
     def get_loss(self, batch):
         batch_size = len(batch.state)
         rewards, last_step, done, actions, state, next_state = self.unpack_data(batch)
-        action_out = self.policy(state) #  (b,n,a) action probability
-        values = self.value(state, actions) # (b,n,a) action value
+        alive_mask, next_alive_mask = self.unpack_alive_masks(batch)
+        info, next_info = {'alive_mask': alive_mask}, {'alive_mask': next_alive_mask}
+        action_out = self.policy(state, info=info) #  (b,n,a) action probability
+        values = self.value(state, actions, info=info) # (b,n,a) action value
         baselines = torch.sum(values*torch.softmax(action_out, dim=-1), dim=-1)   # the only difference to ActorCritic is this  baseline (b,n)
         values = torch.sum(values*actions, dim=-1) # (b,n)
         if self.args.target:
-            next_action_out = self.target_net.policy(next_state, last_act=actions)
+            next_action_out = self.target_net.policy(next_state, last_act=actions, info=next_info)
         else:
-            next_action_out = self.policy(next_state, last_act=actions)
+            next_action_out = self.policy(next_state, last_act=actions, info=next_info)
         next_actions = select_action(self.args, next_action_out, status='train',  exploration=False)
         if self.args.target:
-            next_values = self.target_net.value(next_state, next_actions)
+            next_values = self.target_net.value(next_state, next_actions, info=next_info)
         else:
-            next_values = self.value(next_state, next_actions)
+            next_values = self.value(next_state, next_actions, info=next_info)
         next_values = torch.sum(next_values*next_actions, dim=-1) # b*n
+        if next_alive_mask is not None:
+            # the cars that leave have no next value
+            next_values = next_values * next_alive_mask
         # calculate the advantages
-        returns = cuda_wrapper(torch.zeros((batch_size, self.n_), dtype=torch.float), self.cuda_)
         assert values.size() == next_values.size()
+        returns = compute_returns(self.args, rewards, last_step, done, values, next_values)
         assert returns.size() == values.size()
-        for i in reversed(range(rewards.size(0))):
-            if last_step[i]:
-                next_return = 0 if done[i] else next_values[i].detach()
-            else:
-                next_return = next_values[i].detach()
-            returns[i] = rewards[i] + self.args.gamma * next_return
         # value loss
         deltas = returns - values
-        value_loss = deltas.pow(2).mean(dim=0)
+        value_loss = masked_mean(deltas.pow(2), alive_mask)
         # actio loss
         advantages = ( values - baselines ).detach()
         if self.args.normalize_advantages:
@@ -133,5 +101,5 @@ class COMAFC(Model):
         log_prob = multinomials_log_density(actions, action_out).contiguous().view(-1, self.n_)
         assert log_prob.size() == advantages.size()
         action_loss = - advantages * log_prob
-        action_loss = action_loss.mean(dim=0)
+        action_loss = masked_mean(action_loss, alive_mask)
         return action_loss, value_loss, action_out
@@ -3,6 +3,7 @@ import torch.nn as nn
 import numpy as np
 from utilities.util import *
 from models.model import Model
+from models.layers import MultiAgentLinear
 from learning_algorithms.ddpg import *
 from collections import namedtuple
 
@@ -17,78 +18,30 @@ class IndependentDDPG(Model):
         if target_net != None:
             self.target_net = target_net
             self.reload_params_to_target()
-        self.Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state', 'done', 'last_step'))
+        self.Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state', 'done', 'last_step', 'alive_mask', 'next_alive_mask'), defaults=(None, None))
         self.rl = DDPG(self.args)
 
-    def construct_policy_net(self):
-        action_dicts = []
-        if self.args.shared_parameters:
-            l1 = nn.Linear(self.obs_dim, self.hid_dim)
-            l2 = nn.Linear(self.hid_dim, self.hid_dim)
-            a = nn.Linear(self.hid_dim, self.act_dim)
-            for i in range(self.n_):
-                action_dicts.append(nn.ModuleDict( {'layer_1': l1,\
-                                                    'layer_2': l2,\
-                                                    'action_head': a
-                                                    }
-                                                 )
-                                   )
-        else:
-            for i in range(self.n_):
-                action_dicts.append(nn.ModuleDict( {'layer_1': nn.Linear(self.obs_dim, self.hid_dim),\
-                                                    'layer_2': nn.Linear(self.hid_dim, self.hid_dim),\
-                                                    'action_head': nn.Linear(self.hid_dim, self.act_dim)
-                                                    }
-                                                  )
-                                   )
-        self.action_dicts = nn.ModuleList(action_dicts)
-
     def construct_value_net(self):
-        value_dicts = []
-        if self.args.shared_parameters:
-            l1 = nn.Linear(self.obs_dim+self.act_dim, self.hid_dim )
-            l2 = nn.Linear(self.hid_dim, self.hid_dim)
-            v = nn.Linear(self.hid_dim, 1)
-            for i in range(self.n_):
-                value_dicts.append(nn.ModuleDict( {'layer_1': l1,\
-                                                   'layer_2': l2,\
-                                                   'value_head': v
-                                                  }
-                                                )
-                                  )
-        else:
-            for i in range(self.n_):
-                value_dicts.append(nn.ModuleDict( {'layer_1': nn.Linear(self.obs_dim+self.act_dim, self.hid_dim ),\
-                                                   'layer_2': nn.Linear(self.hid_dim, self.hid_dim),\
-                                                   'value_head': nn.Linear(self.hid_dim, 1)
-                                                  }
-                                                )
-                                  )
-        self.value_dicts = nn.ModuleList(value_dicts)
+        shared = self.args.shared_parameters
+        self.value_dicts = nn.ModuleDict( {'layer_1': MultiAgentLinear(self.n_, self.obs_dim+self.act_dim, self.hid_dim, shared),\
+                                           'layer_2': MultiAgentLinear(self.n_, self.hid_dim, self.hid_dim, shared),\
+                                           'value_head': MultiAgentLinear(self.n_, self.hid_dim, 1, shared)
+                                          }
+                                        )
 
     def construct_model(self):
         self.construct_value_net()
         self.construct_policy_net()
 
-    def policy(self, obs, schedule=None, last_act=None, last_hid=None, info={}, stat={}):
-        actions = []
-        for i in range(self.n_):
-            h = torch.relu( self.action_dicts[i]['layer_1'](obs[:, i, :]) )
-            h = torch.relu( self.action_dicts[i]['layer_2'](h) )
-            a = self.action_dicts[i]['action_head'](h)
-            actions.append(a)
-        actions = torch.stack(actions, dim=1)
-        return actions
-
-    def value(self, obs, act):
-        values = []
-        for i in range(self.n_):
-            h = torch.relu( self.value_dicts[i]['layer_1']( torch.cat((obs[:,i,:],act[:,i,:]),dim=-1)))
-            h = torch.relu( self.value_dicts[i]['layer_2'](h) )
-            v = self.value_dicts[i]['value_head'](h)
-            values.append(v)
-        values = torch.stack(values, dim=1)
-        return values
+    def value(self, obs, act, info={}):
+        packing = self.get_agent_mask(info)
+        inp = torch.cat((obs, act), dim=-1) # shape = (b, n, o+a)
+        if packing is not None:
+            inp = packing.pack(inp) # shape = (N, o+a)
+        h = torch.relu( self.value_dicts['layer_1'](inp, packing=packing) )
+        h = torch.relu( self.value_dicts['layer_2'](h, packing=packing) )
+        values = self.value_dicts['value_head'](h, packing=packing)
+        return values if packing is None else packing.unpack(values)
 
     def get_loss(self, batch):
         action_loss, value_loss, log_p_a = self.rl.get_loss(batch, self, self.target_net)
@@ -0,0 +1,121 @@
+import math
+import re
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+
+
+class MultiAgentLinear(nn.Module):
+    '''
+    the linear layers of n agents evaluated with one batched matmul, the weight has the shape (n, in, out)
+    or (1, in, out) if the agents share the parameters
+    '''
+
+    def __init__(self, agent_num, in_features, out_features, shared=False):
+        super(MultiAgentLinear, self).__init__()
+        self.agent_num = agent_num
+        self.in_features = in_features
+        self.out_features = out_features
+        self.shared = bool(shared)
+        k = 1 if self.shared else agent_num
+        self.weight = nn.Parameter(torch.Tensor(k, in_features, out_features))
+        self.bias = nn.Parameter(torch.Tensor(k, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # the default initialization of nn.Linear
+        bound = 1 / math.sqrt(self.in_features)
+        self.weight.data.uniform_(-bound, bound)
+        self.bias.data.uniform_(-bound, bound)
+
+    def forward(self, x, features=None, bias=True, packing=None):
+        '''
+        x shape = (..., n, in) -> (..., n, out), features is a slice of the input features that x holds,
+        or x shape = (N, in) -> (N, out) holds the rows of the alive agents given by packing
+        '''
+        weight = self.weight if features is None else self.weight[:, features]
+        size = x.size()
+        if self.shared:
+            # one gemm over all agents and batch entries, with the bias fused
+            x = x.contiguous().view(-1, weight.size(1))
+            out = torch.addmm(self.bias[0], x, weight[0]) if bias else torch.mm(x, weight[0])
+            return out.view(*size[:-1], self.out_features)
+        if packing is None:
+            x = x.contiguous().view(-1, self.agent_num, weight.size(1)).transpose(0, 1) # shape = (n, *, in)
+        else:
+            # the rows of every agent are gathered into one padded batch, so only the alive rows are multiplied
+            x = x.new_zeros(self.agent_num, packing.padded, weight.size(1)).index_put_((packing.agent, packing.rank), x) # shape = (n, padded, in)
+        if bias:
+            out = torch.baddbmm(self.bias.unsqueeze(1), x, weight) # shape = (n, *, out)
+        else:
+            out = torch.bmm(x, weight)
+        if packing is not None:
+            return out[packing.agent, packing.rank]
+        return out.transpose(0, 1).contiguous().view(*size[:-1], self.out_features)
+
+    def forward_shared_input(self, x, features=None, bias=True):
+        '''
+        x shape = (..., in) -> (..., n, out), the input seen by every agent is multiplied with the weights of all agents in one wide matmul
+        '''
+        weight = self.weight if features is None else self.weight[:, features]
+        k = weight.size(0)
+        weight = weight.transpose(0, 1).contiguous().view(weight.size(1), k*self.out_features) # shape = (in, k*out)
+        out = torch.matmul(x, weight)
+        if bias:
+            out = out + self.bias.view(-1)
+        out = out.view(*x.size()[:-1], k, self.out_features)
+        return out.expand(*x.size()[:-1], self.agent_num, self.out_features)
+
+    def extra_repr(self):
+        return 'agent_num={}, in_features={}, out_features={}, shared={}'.format(self.agent_num, self.in_features, self.out_features, self.shared)
+
+
+
+class AgentPacking(object):
+    '''
+    the alive rows of a mask shape = (b, n) in the order of the batch, the rank of a row among the alive rows
+    of its agent is its place in the padded batch of that agent
+    '''
+
+    def __init__(self, mask):
+        self.mask = mask.float()
+        mask = mask > 0
+        self.size = mask.size()
+        self.batch, self.agent = mask.nonzero(as_tuple=True)
+        self.rank = (mask.long().cumsum(dim=0) - 1)[self.batch, self.agent]
+        self.padded = int(mask.sum(dim=0).max().item())
+
+    def pack(self, x):
+        '''
+        x shape = (b, n, ...) -> (N, ...)
+        '''
+        return x[self.batch, self.agent]
+
+    def unpack(self, x):
+        '''
+        x shape = (N, ...) -> (b, n, ...), the rows of the dead agents are zero
+        '''
+        out = x.new_zeros(self.size + x.size()[1:])
+        out[self.batch, self.agent] = x
+        return out
+
+
+
+def convert_legacy_state_dict(state_dict, prefixes=('action_dicts', 'value_dicts')):
+    '''
+    stack the per-agent nn.Linear entries of the checkpoints saved before MultiAgentLinear,
+    e.g. action_dicts.0.layer_1.weight of shape (out, in) -> action_dicts.layer_1.weight of shape (n, in, out)
+    '''
+    pattern = re.compile(r'^(.*(?:{}))\.(\d+)\.(\w+)\.(weight|bias)$'.format('|'.join(prefixes)))
+    converted, stacks = OrderedDict(), OrderedDict()
+    for key, value in state_dict.items():
+        match = pattern.match(key)
+        if match is None:
+            converted[key] = value
+            continue
+        prefix, i, layer, name = match.groups()
+        stacks.setdefault('{}.{}.{}'.format(prefix, layer, name), dict())[int(i)] = value.t() if name == 'weight' else value
+    for key, values in stacks.items():
+        converted[key] = torch.stack([values[i] for i in sorted(values)], dim=0)
+    return converted
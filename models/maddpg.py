@@ -3,6 +3,7 @@ import torch.nn as nn
 import numpy as np
 from utilities.util import *
 from models.model import Model
+from models.layers import MultiAgentLinear
 from learning_algorithms.ddpg import *
 from collections import namedtuple
 
@@ -17,113 +18,77 @@ class MADDPG(Model):
         if target_net != None:
             self.target_net = target_net
             self.reload_params_to_target()
-        self.Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state', 'done', 'last_step'))
-
-    def construct_policy_net(self):
-        # TODO: fix policy params update
-        action_dicts = []
-        if self.args.shared_parameters:
-            l1 = nn.Linear(self.obs_dim, self.hid_dim)
-            l2 = nn.Linear(self.hid_dim, self.hid_dim)
-            a = nn.Linear(self.hid_dim, self.act_dim)
-            for i in range(self.n_):
-                action_dicts.append(nn.ModuleDict( {'layer_1': l1,\
-                                                    'layer_2': l2,\
-                                                    'action_head': a
-                                                    }
-                                                 )
-                                   )
-        else:
-            for i in range(self.n_):
-                action_dicts.append(nn.ModuleDict( {'layer_1': nn.Linear(self.obs_dim, self.hid_dim),\
-                                                    'layer_2': nn.Linear(self.hid_dim, self.hid_dim),\
-                                                    'action_head': nn.Linear(self.hid_dim, self.act_dim)
-                                                    }
-                                                  )
-                                   )
-        self.action_dicts = nn.ModuleList(action_dicts)
+        self.Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state', 'done', 'last_step', 'alive_mask', 'next_alive_mask'), defaults=(None, None))
 
     def construct_value_net(self):
-        # TODO: policy params update
-        value_dicts = []
-        if self.args.shared_parameters:
-            l1 = nn.Linear( (self.obs_dim+self.act_dim)*self.n_, self.hid_dim )
-            l2 = nn.Linear(self.hid_dim, self.hid_dim)
-            v = nn.Linear(self.hid_dim, 1)
-            for i in range(self.n_):
-                value_dicts.append(nn.ModuleDict( {'layer_1': l1,\
-                                                   'layer_2': l2,\
-                                                   'value_head': v
-                                                  }
-                                                )
-                                  )
-        else:
-            for i in range(self.n_):
-                value_dicts.append(nn.ModuleDict( {'layer_1': nn.Linear( (self.obs_dim+self.act_dim)*self.n_, self.hid_dim ),\
-                                                   'layer_2': nn.Linear(self.hid_dim, self.hid_dim),\
-                                                   'value_head': nn.Linear(self.hid_dim, 1)
-                                                  }
-                                                )
-                                  )
-        self.value_dicts = nn.ModuleList(value_dicts)
+        if self.args.critic_type == 'attention':
+            self.construct_attention_value_net(1)
+            return
+        shared = self.args.shared_parameters
+        self.value_dicts = nn.ModuleDict( {'layer_1': MultiAgentLinear(self.n_, (self.obs_dim+self.act_dim)*self.n_, self.hid_dim, shared),\
+                                           'layer_2': MultiAgentLinear(self.n_, self.hid_dim, self.hid_dim, shared),\
+                                           'value_head': MultiAgentLinear(self.n_, self.hid_dim, 1, shared)
+                                          }
+                                        )
 
     def construct_model(self):
         self.construct_value_net()
         self.construct_policy_net()
 
-    def policy(self, obs, schedule=None, last_act=None, last_hid=None, info={}, stat={}):
-        # TODO: policy params update
-        actions = []
-        for i in range(self.n_):
-            h = torch.relu( self.action_dicts[i]['layer_1'](obs[:, i, :]) )
-            h = torch.relu( self.action_dicts[i]['layer_2'](h) )
-            a = self.action_dicts[i]['action_head'](h)
-            actions.append(a)
-        actions = torch.stack(actions, dim=1)
-        return actions
+    def value(self, obs, act, info={}):
+        packing = self.get_agent_mask(info)
+        if packing is not None:
+            # the dead agents take no action
+            act = act * packing.mask.unsqueeze(-1)
+        if self.args.critic_type == 'attention':
+            return self.attention_value(obs, act.unsqueeze(1))[:, 0, 0] # shape = (b, n, 1)
+        batch_size = obs.size(0)
+        # every critic sees the same input, so it is built once and the first layers of all critics are fused
+        inp = torch.cat( ( obs.contiguous().view(batch_size, -1), act.contiguous().view(batch_size, -1) ), dim=-1 ) # shape = (b, (o+a)*n)
+        h = torch.relu( self.value_dicts['layer_1'].forward_shared_input(inp) ) # shape = (b, n, h)
+        if packing is not None:
+            h = packing.pack(h) # shape = (N, h)
+        h = torch.relu( self.value_dicts['layer_2'](h, packing=packing) )
+        values = self.value_dicts['value_head'](h, packing=packing)
+        return values if packing is None else packing.unpack(values)
 
-    def value(self, obs, act):
-        # TODO: policy params update
-        values = []
-        for i in range(self.n_):
-            h = torch.relu( self.value_dicts[i]['layer_1']( torch.cat( ( obs.contiguous().view( -1, np.prod(obs.size()[1:]) ), act.contiguous().view( -1, np.prod(act.size()[1:]) ) ), dim=-1 ) ) )
-            h = torch.relu( self.value_dicts[i]['layer_2'](h) )
-            v = self.value_dicts[i]['value_head'](h)
-            values.append(v)
-        values = torch.stack(values, dim=1)
-        return values
+    def target_next_values(self, next_state, next_alive_mask=None):
+        '''
+        do the argmax action of the target policy on the target critic
+        '''
+        next_info = {'alive_mask': next_alive_mask}
+        next_action_out = self.target_net.policy(next_state, info=next_info)
+        next_actions_ = select_action(self.args, next_action_out, status='train', exploration=False)
+        return self.target_net.value(next_state, next_actions_.detach(), info=next_info).contiguous().view(-1, self.n_)
 
     def get_loss(self, batch):
         # TODO: fix policy params update
         batch_size = len(batch.state)
         # collect the transition data
         rewards, last_step, done, actions, state, next_state = self.unpack_data(batch)
+        alive_mask, next_alive_mask = self.unpack_alive_masks(batch)
+        info = {'alive_mask': alive_mask}
         # construct the computational graph
         # do the argmax action on the action loss
-        action_out = self.policy(state)
+        action_out = self.policy(state, info=info)
         actions_ = select_action(self.args, action_out, status='train', exploration=False)
-        values_ = self.value(state, actions_).contiguous().view(-1, self.n_)
+        values_ = self.value(state, actions_, info=info).contiguous().view(-1, self.n_)
         # do the exploration action on the value loss
-        values = self.value(state, actions).contiguous().view(-1, self.n_)
+        values = self.value(state, actions, info=info).contiguous().view(-1, self.n_)
         # do the argmax action on the next value loss
-        next_action_out = self.target_net.policy(next_state)
-        next_actions_ = select_action(self.args, next_action_out, status='train', exploration=False)
-        next_values_ = self.target_net.value(next_state, next_actions_.detach()).contiguous().view(-1, self.n_)
-        returns = cuda_wrapper(torch.zeros((batch_size, self.n_), dtype=torch.float), self.cuda_)
+        next_values_ = self.target_values(next_state, self.target_next_values, next_alive_mask)
+        if next_alive_mask is not None:
+            # the cars that leave have no next value
+            next_values_ = next_values_ * next_alive_mask
         assert values_.size() == next_values_.size()
+        returns = td_target(rewards, last_step, done, next_values_, self.args.gamma)
         assert returns.size() == values.size()
-        for i in reversed(range(rewards.size(0))):
-            if last_step[i]:
-                next_return = 0 if done[i] else next_values_[i].detach()
-            else:
-                next_return = next_values_[i].detach()
-            returns[i] = rewards[i] + self.args.gamma * next_return
         deltas = returns - values
         advantages = values_
         # advantages = advantages.contiguous().view(-1, 1)
         if self.args.normalize_advantages:
             advantages = batchnorm(advantages)
         action_loss = -advantages
-        action_loss = action_loss.mean(dim=0)
-        value_loss = deltas.pow(2).mean(dim=0)
+        action_loss = masked_mean(action_loss, alive_mask)
+        value_loss = masked_mean(deltas.pow(2), alive_mask)
         return action_loss, value_loss, action_out
@@ -0,0 +1,95 @@
+import torch
+import torch.nn as nn
+import numpy as np
+from utilities.util import *
+from models.model import Model
+from models.layers import MultiAgentLinear
+from collections import namedtuple
+
+
+
+class MFAC(Model):
+
+    def __init__(self, args, target_net=None):
+        super(MFAC, self).__init__(args)
+        self.construct_model()
+        self.apply(self.init_weights)
+        if target_net != None:
+            self.target_net = target_net
+            self.reload_params_to_target()
+        self.Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state', 'done', 'last_step', 'alive_mask', 'next_alive_mask'), defaults=(None, None))
+
+    def construct_value_net(self):
+        shared = self.args.shared_parameters
+        self.value_dicts = nn.ModuleDict( {'layer_1': MultiAgentLinear(self.n_, self.obs_dim+self.act_dim, self.hid_dim, shared),\
+                                           'layer_2': MultiAgentLinear(self.n_, self.hid_dim, self.hid_dim, shared),\
+                                           'value_head': MultiAgentLinear(self.n_, self.hid_dim, self.act_dim, shared)
+                                          }
+                                        )
+
+    def construct_model(self):
+        self.construct_value_net()
+        self.construct_policy_net()
+
+    def mean_action(self, act, mask=None):
+        '''
+        the mean action of the neighbours of every agent, i.e. all other (alive) agents, act shape = (b, n, a) -> (b, n, a)
+        '''
+        if mask is None:
+            return ( act.sum(dim=1, keepdim=True) - act ) / max(self.n_-1, 1)
+        act = act * mask.unsqueeze(-1)
+        others = ( mask.sum(dim=1, keepdim=True) - mask ).clamp(min=1).unsqueeze(-1) # shape = (b, n, 1)
+        return ( act.sum(dim=1, keepdim=True) - act ) / others
+
+    def value(self, obs, act, info={}):
+        '''
+        the action values of the own actions given the own observation and the mean action of the neighbours,
+        so the input size does not depend on the number of agents, shape = (b, n, a)
+        '''
+        packing = self.get_agent_mask(info)
+        inp = torch.cat((obs, self.mean_action(act, None if packing is None else packing.mask)), dim=-1) # shape = (b, n, o+a)
+        if packing is not None:
+            inp = packing.pack(inp) # shape = (N, o+a)
+        h = torch.relu( self.value_dicts['layer_1'](inp, packing=packing) )
+        h = torch.relu( self.value_dicts['layer_2'](h, packing=packing) )
+        values = self.value_dicts['value_head'](h, packing=packing)
+        return values if packing is None else packing.unpack(values)
+
+    def get_loss(self, batch):
+        batch_size = len(batch.state)
+        rewards, last_step, done, actions, state, next_state = self.unpack_data(batch)
+        alive_mask, next_alive_mask = self.unpack_alive_masks(batch)
+        info, next_info = {'alive_mask': alive_mask}, {'alive_mask': next_alive_mask}
+        action_out = self.policy(state, info=info) # (b,n,a) action probability
+        values = self.value(state, actions, info=info) # (b,n,a) action value
+        baselines = torch.sum(values*torch.softmax(action_out, dim=-1), dim=-1) # (b,n)
+        values = torch.sum(values*actions, dim=-1) # (b,n)
+        if self.args.target:
+            next_action_out = self.target_net.policy(next_state, info=next_info)
+        else:
+            next_action_out = self.policy(next_state, info=next_info)
+        next_actions = select_action(self.args, next_action_out, status='train', exploration=False)
+        if self.args.target:
+            next_values = self.target_net.value(next_state, next_actions, info=next_info)
+        else:
+            next_values = self.value(next_state, next_actions, info=next_info)
+        # the mean field value is the expected action value under the policy
+        next_values = torch.sum(next_values*torch.softmax(next_action_out, dim=-1), dim=-1) # (b,n)
+        if next_alive_mask is not None:
+            # the cars that leave have no next value
+            next_values = next_values * next_alive_mask
+        assert values.size() == next_values.size()
+        returns = compute_returns(self.args, rewards, last_step, done, values, next_values)
+        assert returns.size() == values.size()
+        # value loss
+        deltas = returns - values
+        value_loss = masked_mean(deltas.pow(2), alive_mask)
+        # action loss
+        advantages = ( values - baselines ).detach()
+        if self.args.normalize_advantages:
+            advantages = batchnorm(advantages)
+        log_prob = multinomials_log_density(actions, action_out).contiguous().view(-1, self.n_)
+        assert log_prob.size() == advantages.size()
+        action_loss = - advantages * log_prob
+        action_loss = masked_mean(action_loss, alive_mask)
+        return action_loss, value_loss, action_out
@@ -1,7 +1,9 @@
+import math
 import torch
 import torch.nn as nn
 import numpy as np
 from utilities.util import *
+from models.layers import MultiAgentLinear, AgentPacking, convert_legacy_state_dict
 
 
 
@@ -15,43 +17,104 @@ class Model(nn.Module):
         self.hid_dim = self.args.hid_size
         self.obs_dim = self.args.obs_size
         self.act_dim = self.args.action_dim
+        # the statistics collected by get_loss, merged into the training stat by the trainer
+        self.loss_stat = dict()
+        # the target cache of the replay slots attached by the trainer, batch_keys are the keys of the sampled batch
+        self.target_cache = None
+        self.batch_keys = None
+        self.target_version = 0
+
+    def load_state_dict(self, state_dict, strict=True):
+        '''
+        accept the checkpoints saved with per-agent nn.Linear layers as well
+        '''
+        state_dict = convert_legacy_state_dict(state_dict)
+        own_state = self.state_dict()
+        for key, value in state_dict.items():
+            # the legacy checkpoints of shared parameters repeat the layer for every agent
+            if key in own_state and own_state[key].dim() == value.dim() and own_state[key].size(0) == 1 and value.size(0) > 1:
+                state_dict[key] = value[:1]
+        self.target_version += 1
+        return super(Model, self).load_state_dict(state_dict, strict)
+
+    def target_params(self):
+        '''
+        the pairs of the behaviour and target parameter lists, collected once
+        '''
+        if not hasattr(self, 'target_param_pairs'):
+            params = list(self.action_dicts.parameters()) + list(self.value_dicts.parameters())
+            target_params = list(self.target_net.action_dicts.parameters()) + list(self.target_net.value_dicts.parameters())
+            self.target_param_pairs = (params, target_params)
+        return self.target_param_pairs
 
     def reload_params_to_target(self):
-        self.target_net.action_dicts.load_state_dict( self.action_dicts.state_dict() )
-        self.target_net.value_dicts.load_state_dict( self.value_dicts.state_dict() )
+        params, target_params = self.target_params()
+        self.target_version += 1
+        with torch.no_grad():
+            if hasattr(torch, '_foreach_copy_'):
+                torch._foreach_copy_(target_params, params)
+            else:
+                for target_param, param in zip(target_params, params):
+                    target_param.copy_(param)
 
     def update_target(self):
-        for name, param in self.target_net.action_dicts.state_dict().items():
-            update_params = (1 - self.args.target_lr) * param + self.args.target_lr * self.action_dicts.state_dict()[name]
-            self.target_net.action_dicts.state_dict()[name].copy_(update_params)
-        for name, param in self.target_net.value_dicts.state_dict().items():
-            update_params = (1 - self.args.target_lr) * param + self.args.target_lr * self.value_dicts.state_dict()[name]
-            self.target_net.value_dicts.state_dict()[name].copy_(update_params)
+        '''
+        the soft update target <- target + target_lr * (behaviour - target) in place, target_lr=1 copies the parameters
+        '''
+        if self.args.target_lr == 1:
+            self.reload_params_to_target()
+            return
+        params, target_params = self.target_params()
+        self.target_version += 1
+        with torch.no_grad():
+            if hasattr(torch, '_foreach_lerp_'):
+                torch._foreach_lerp_(target_params, params, self.args.target_lr)
+            else:
+                for target_param, param in zip(target_params, params):
+                    target_param.lerp_(param, self.args.target_lr)
+
+    def target_values(self, next_state, compute, next_alive_mask=None):
+        '''
+        the target next state values of a batch given by compute(next_state, next_alive_mask), the values cached for the
+        replay slots of the batch under the current target version are reused
+        '''
+        keys, self.batch_keys = self.batch_keys, None
+        if self.target_cache is None or keys is None or keys[0].size(0) != next_state.size(0):
+            return compute(next_state, next_alive_mask)
+        values = self.target_cache.get(keys, self.target_version, (next_state, next_alive_mask), compute)
+        self.loss_stat['target_cache_hit_rate'] = self.target_cache.hit_rate()
+        return values
 
     def transition_update(self, trainer, trans, stat):
+        '''
+        trans is the list of transitions collected by one step of all environments
+        '''
         if self.args.replay:
-            trainer.replay_buffer.add_experience(trans)
-            replay_cond = trainer.steps>self.args.replay_warmup\
-             and len(trainer.replay_buffer.buffer)>=self.args.batch_size\
-             and trainer.steps%self.args.behaviour_update_freq==0
-            if replay_cond:
-                for _ in range(self.args.critic_update_times):
-                    trainer.value_replay_process(stat)
-                trainer.action_replay_process(stat)
-                # TODO: hard code
-                # clear replay buffer for on policy algorithm
-                if self.__class__.__name__ in ["COMAFC","MFAC","IndependentAC"] :
-                    trainer.replay_buffer.clear()
-        else:
-            trans_cond = trainer.steps%self.args.behaviour_update_freq==0
-            if trans_cond:
-                for _ in range(self.args.critic_update_times):
-                    trainer.value_replay_process(stat)
-                trainer.action_transition_process(stat, trans)
-        if self.args.target:
-            target_cond = trainer.steps%self.args.target_update_freq==0
-            if target_cond:
-                self.update_target()
+            trainer.replay_buffer.add_experiences(trans)
+        for _ in range(len(trans)):
+            if self.args.replay:
+                replay_cond = trainer.steps>self.args.replay_warmup\
+                 and len(trainer.replay_buffer.buffer)>=self.args.batch_size\
+                 and trainer.steps%self.args.behaviour_update_freq==0
+                if replay_cond:
+                    for _ in range(self.args.critic_update_times):
+                        trainer.value_replay_process(stat)
+                    trainer.action_replay_process(stat)
+                    # TODO: hard code
+                    # clear replay buffer for on policy algorithm
+                    if self.__class__.__name__ in ["COMAFC","MFAC","IndependentAC"] :
+                        trainer.replay_buffer.clear()
+            else:
+                trans_cond = trainer.steps%self.args.behaviour_update_freq==0
+                if trans_cond:
+                    for _ in range(self.args.critic_update_times):
+                        trainer.value_replay_process(stat)
+                    trainer.action_transition_process(stat, self.Transition(*zip(*trans)))
+            if self.args.target:
+                target_cond = trainer.steps%self.args.target_update_freq==0
+                if target_cond:
+                    self.update_target()
+            trainer.steps += 1
 
     def episode_update(self, trainer, episode, stat):
         if self.args.replay:
@@ -74,39 +137,109 @@ class Model(nn.Module):
     def construct_model(self):
         raise NotImplementedError()
 
-    def get_agent_mask(self, batch_size, info):
+    def get_agent_mask(self, info):
+        '''
+        the packing of the alive agents given by info['alive_mask'] of shape = (b, n), None if all agents are evaluated
+        '''
+        mask = info.get('alive_mask') if self.args.alive_mask else None
+        if mask is None:
+            return None
+        if isinstance(mask, np.ndarray):
+            mask = torch.from_numpy(mask)
+        return AgentPacking(cuda_wrapper(mask, self.cuda_))
+
+    def policy(self, obs, schedule=None, last_act=None, last_hid=None, info={}, stat={}):
         '''
-        define the getter of agent mask to confirm the living agent
+        evaluate the policies of all agents at once, obs shape = (b, n, o) -> (b, n, a), only the alive agents are evaluated
+        if info holds the alive mask and the logits of the dead agents are zero
         '''
-        if 'alive_mask' in info:
-            agent_mask = torch.from_numpy(info['alive_mask'])
-            num_agents_alive = agent_mask.sum()
+        packing = self.get_agent_mask(info)
+        if packing is None:
+            layer = lambda name, x, **kwargs: self.action_dicts[name](x, **kwargs)
         else:
-            agent_mask = torch.ones(self.n_)
-            num_agents_alive = self.n_
-        # shape = (1, 1, n)
-        agent_mask = agent_mask.view(1, 1, self.n_)
-        # shape = (batch_size, n ,n, 1)
-        agent_mask = cuda_wrapper(agent_mask.expand(batch_size, self.n_, self.n_).unsqueeze(-1), self.cuda_)
-        return num_agents_alive, agent_mask
-
-    def policy(self, obs, last_act=None, last_hid=None, gate=None, info={}, stat={}):
-        raise NotImplementedError()
+            obs = packing.pack(obs) # shape = (N, o)
+            layer = lambda name, x, **kwargs: self.action_dicts[name](x, packing=packing, **kwargs)
+        if 'agent_embedding' in self.action_dicts:
+            h = layer('layer_1', obs, features=slice(0, self.obs_dim))
+            # the agent ids enter layer_1 as one bias per agent, shape = (n, h)
+            embedding = self.action_dicts['layer_1'](self.action_dicts['agent_embedding'].weight, features=slice(self.obs_dim, None), bias=False)
+            h = h + (embedding if packing is None else embedding[packing.agent])
+            h = torch.relu(h)
+        else:
+            h = torch.relu( layer('layer_1', obs) )
+        h = torch.relu( layer('layer_2', h) )
+        a = layer('action_head', h)
+        return a if packing is None else packing.unpack(a)
 
     def value(self, obs, act):
         raise NotImplementedError()
 
     def construct_policy_net(self):
-        raise NotImplementedError()
+        shared = self.args.shared_parameters
+        embedding_dim = self.args.agent_id_embedding
+        self.action_dicts = nn.ModuleDict( {'layer_1': MultiAgentLinear(self.n_, self.obs_dim+embedding_dim, self.hid_dim, shared),\
+                                            'layer_2': MultiAgentLinear(self.n_, self.hid_dim, self.hid_dim, shared),\
+                                            'action_head': MultiAgentLinear(self.n_, self.hid_dim, self.act_dim, shared)
+                                           }
+                                         )
+        # a learned id of every agent concatenated to the observation, so that the shared policy can tell the agents apart
+        if embedding_dim:
+            self.action_dicts['agent_embedding'] = nn.Embedding(self.n_, embedding_dim)
 
     def construct_value_net(self):
         raise NotImplementedError()
 
+    def construct_attention_value_net(self, output_dim):
+        '''
+        one critic shared by all agents, every agent is a token of its observation and action and the critic of agent i
+        attends over the tokens of all agents, so the parameters do not depend on the number of agents
+        '''
+        self.value_dicts = nn.ModuleDict( {'encoder': MultiAgentLinear(self.n_, self.obs_dim+self.act_dim, self.hid_dim, True),\
+                                           'query': MultiAgentLinear(self.n_, self.hid_dim, self.hid_dim, True),\
+                                           'key': MultiAgentLinear(self.n_, self.hid_dim, self.hid_dim, True),\
+                                           'value': MultiAgentLinear(self.n_, self.hid_dim, self.hid_dim, True),\
+                                           'layer_2': MultiAgentLinear(self.n_, 2*self.hid_dim, self.hid_dim, True),\
+                                           'value_head': MultiAgentLinear(self.n_, self.hid_dim, output_dim, True)
+                                          }
+                                        )
+
+    def attention_value(self, obs, act, member=None):
+        '''
+        obs shape = (b, n, o), act shape = (b, k, n, a), member shape = (b, m, n, n) marks the agents j whose actions are seen
+        by the critic of agent i, the other agents are seen by their observations alone -> (b, k, m, n, output_dim)
+        '''
+        heads = self.args.attention_heads
+        head_dim = self.hid_dim // heads
+        split = lambda x: x.contiguous().view(*x.size()[:-1], heads, head_dim).transpose(-2, -3) # shape = (..., n, h) -> (..., heads, n, h/heads)
+        merge = lambda x: x.transpose(-2, -3).contiguous().view(*x.size()[:-3], x.size(-2), self.hid_dim)
+        obs_features = slice(0, self.obs_dim)
+        act_features = slice(self.obs_dim, self.obs_dim+self.act_dim)
+        h_obs = self.value_dicts['encoder'](obs, features=obs_features) # shape = (b, n, h)
+        tokens = torch.relu( h_obs.unsqueeze(1) + self.value_dicts['encoder'](act, features=act_features, bias=False) ) # shape = (b, k, n, h)
+        queries, keys, values = [split(self.value_dicts[name](tokens)) for name in ('query', 'key', 'value')] # shape = (b, k, heads, n, h/heads)
+        if member is None:
+            weights = torch.softmax( torch.matmul(queries, keys.transpose(-1, -2)) / math.sqrt(head_dim), dim=-1 ) # shape = (b, k, heads, n, n)
+            context = merge(torch.matmul(weights, values)).unsqueeze(2) # shape = (b, k, 1, n, h)
+            own = tokens.unsqueeze(2)
+        else:
+            # the tokens without the actions, the query of agent i comes from its own token as seen by its critic
+            empty = torch.relu(h_obs) # shape = (b, n, h)
+            queries_, keys_, values_ = [split(self.value_dicts[name](empty))[:, None, None] for name in ('query', 'key', 'value')] # shape = (b, 1, 1, heads, n, h/heads)
+            seen = member.diagonal(dim1=-2, dim2=-1).unsqueeze(1) # shape = (b, 1, m, n)
+            own = seen.unsqueeze(-1) * tokens.unsqueeze(2) + (1 - seen.unsqueeze(-1)) * empty[:, None, None] # shape = (b, k, m, n, h)
+            queries = seen.unsqueeze(-2).unsqueeze(-1) * queries.unsqueeze(2) + (1 - seen.unsqueeze(-2).unsqueeze(-1)) * queries_ # shape = (b, k, m, heads, n, h/heads)
+            member = member.unsqueeze(1).unsqueeze(3) # shape = (b, 1, m, 1, n, n)
+            logits = member * torch.matmul(queries, keys.unsqueeze(2).transpose(-1, -2)) + (1 - member) * torch.matmul(queries, keys_.transpose(-1, -2))
+            weights = torch.softmax( logits / math.sqrt(head_dim), dim=-1 ) # shape = (b, k, m, heads, n, n)
+            context = merge(torch.matmul(weights * member, values.unsqueeze(2)) + torch.matmul(weights * (1 - member), values_)) # shape = (b, k, m, n, h)
+        h = torch.relu( self.value_dicts['layer_2'](torch.cat((own, context), dim=-1)) )
+        return self.value_dicts['value_head'](h)
+
     def init_weights(self, m):
         '''
         initialize the weights of parameters
         '''
-        if type(m) == nn.Linear:
+        if type(m) in [nn.Linear, MultiAgentLinear]:
             m.weight.data.normal_(0, self.args.init_std)
 
     def get_loss(self):
@@ -121,56 +254,98 @@ class Model(nn.Module):
         return values
 
 
-    def train_process(self, stat, trainer):
+    def train_process(self, stat, trainer, steps=None):
+        '''
+        step all environment copies with one batched policy forward until as many episodes as copies have finished
+        (or for exactly steps batched steps if given), the environments are reset independently and
+        the unfinished episodes carry over to the next call
+        '''
         info = {}
-        state = trainer.env.reset()
-        if self.args.reward_record_type is 'episode_mean_step':
-            trainer.mean_reward = 0
-            trainer.mean_success = 0
-
-        for t in range(self.args.max_steps):
-            state_ = cuda_wrapper(prep_obs(state).contiguous().view(1, self.n_, self.obs_dim), self.cuda_)
-            start_step = True if t == 0 else False
-            state_ = cuda_wrapper(prep_obs(state).contiguous().view(1, self.n_, self.obs_dim), self.cuda_)
+        if trainer.states is None:
+            trainer.states = [env.reset() for env in trainer.envs]
+            trainer.alive_masks = [initial_alive_mask(env, self.n_) for env in trainer.envs]
+        episode_rewards, episode_successes, episode_turns = [], [], []
+        step = 0
+        while (len(episode_turns) < len(trainer.envs)) if steps is None else (step < steps):
+            step += 1
+            state_ = cuda_wrapper(torch.stack([prep_obs(state) for state in trainer.states]).contiguous().view(-1, self.n_, self.obs_dim), self.cuda_)
+            info['alive_mask'] = np.stack(trainer.alive_masks)
             action_out = self.policy(state_, info=info, stat=stat)
             action = select_action(self.args, action_out, status='train', info=info)
-            _, actual = translate_action(self.args, action, trainer.env)
-            next_state, reward, done, debug = trainer.env.step(actual)
-            if isinstance(done, list): done = np.sum(done)
-            done_ = done or t==self.args.max_steps-1
-            trans = self.Transition(state,
-                                    action.cpu().numpy(),
-                                    np.array(reward),
-                                    next_state,
-                                    done,
-                                    done_
-                                   )
-            self.transition_update(trainer, trans, stat)
-            success = debug['success'] if 'success' in debug else 0.0
-            trainer.steps += 1
-            if self.args.reward_record_type is 'mean_step':
-                trainer.mean_reward = trainer.mean_reward + 1/trainer.steps*(np.mean(reward) - trainer.mean_reward)
-                trainer.mean_success = trainer.mean_success + 1/trainer.steps*(success - trainer.mean_success)
-            elif self.args.reward_record_type is 'episode_mean_step':
-                trainer.mean_reward = trainer.mean_reward + 1/(t+1)*(np.mean(reward) - trainer.mean_reward)
-                trainer.mean_success = trainer.mean_success + 1/(t+1)*(success - trainer.mean_success)
-            else:
-                raise RuntimeError('Please enter a correct reward record type, e.g. mean_step or episode_mean_step.')
-            stat['mean_reward'] = trainer.mean_reward
-            stat['mean_success'] = trainer.mean_success
-            if done_:
-                break
-            state = next_state
-        stat['turn'] = t + 1
-        trainer.episodes += 1
-
+            actuals = translate_actions(self.args, action, trainer.envs)
+            action = action.cpu().numpy()
+            trans, rewards, successes, next_states, next_alive_masks = [], [], [], [], []
+            for i, env in enumerate(trainer.envs):
+                next_state, reward, done, debug = env.step(actuals[i])
+                if isinstance(done, list): done = np.sum(done)
+                done_ = done or trainer.env_steps[i]==self.args.max_steps-1
+                next_alive_mask = debug['alive_mask'] if 'alive_mask' in debug else np.ones(self.n_)
+                trans.append(self.Transition(trainer.states[i],
+                                             action[i:i+1],
+                                             np.array(reward),
+                                             next_state,
+                                             done,
+                                             done_,
+                                             trainer.alive_masks[i],
+                                             next_alive_mask
+                                            )
+                            )
+                rewards.append(np.mean(reward))
+                successes.append(debug['success'] if 'success' in debug else 0.0)
+                next_states.append(next_state)
+                next_alive_masks.append(next_alive_mask)
+            record_steps = trainer.steps
+            trainer.transition_update(trans, stat)
+            for i, env in enumerate(trainer.envs):
+                trainer.env_steps[i] += 1
+                t = trainer.env_steps[i]
+                if self.args.reward_record_type == 'mean_step':
+                    record_steps += 1
+                    trainer.mean_reward = trainer.mean_reward + 1/record_steps*(rewards[i] - trainer.mean_reward)
+                    trainer.mean_success = trainer.mean_success + 1/record_steps*(successes[i] - trainer.mean_success)
+                    stat['mean_reward'] = trainer.mean_reward
+                    stat['mean_success'] = trainer.mean_success
+                elif self.args.reward_record_type == 'episode_mean_step':
+                    trainer.episode_rewards[i] = trainer.episode_rewards[i] + 1/t*(rewards[i] - trainer.episode_rewards[i])
+                    trainer.episode_successes[i] = trainer.episode_successes[i] + 1/t*(successes[i] - trainer.episode_successes[i])
+                else:
+                    raise RuntimeError('Please enter a correct reward record type, e.g. mean_step or episode_mean_step.')
+                if trans[i].last_step:
+                    episode_rewards.append(trainer.episode_rewards[i])
+                    episode_successes.append(trainer.episode_successes[i])
+                    episode_turns.append(t)
+                    trainer.env_steps[i] = 0
+                    trainer.episode_rewards[i] = 0
+                    trainer.episode_successes[i] = 0
+                    next_states[i] = env.reset()
+                    next_alive_masks[i] = initial_alive_mask(env, self.n_)
+                    trainer.episodes += 1
+            trainer.states = next_states
+            trainer.alive_masks = next_alive_masks
+        if not episode_turns:
+            return
+        if self.args.reward_record_type == 'episode_mean_step':
+            stat['mean_reward'] = np.mean(episode_rewards)
+            stat['mean_success'] = np.mean(episode_successes)
+        stat['turn'] = np.mean(episode_turns)
 
     def unpack_data(self, batch):
         batch_size = len(batch.state)
         rewards = cuda_wrapper(torch.tensor(batch.reward, dtype=torch.float), self.cuda_)
-        last_step = cuda_wrapper(torch.tensor(batch.last_step, dtype=torch.float).contiguous().view(-1, 1), self.cuda_)
-        done = cuda_wrapper(torch.tensor(batch.done, dtype=torch.float).contiguous().view(-1, 1), self.cuda_)
+        # the envs with a done flag per agent store the number of agents that are done, so both flags are clamped to {0, 1}
+        last_step = cuda_wrapper((torch.tensor(batch.last_step, dtype=torch.float) > 0).float().contiguous().view(-1, 1), self.cuda_)
+        done = cuda_wrapper((torch.tensor(batch.done, dtype=torch.float) > 0).float().contiguous().view(-1, 1), self.cuda_)
         actions = cuda_wrapper(torch.tensor(np.stack(list(zip(*batch.action))[0], axis=0), dtype=torch.float), self.cuda_)
         state = cuda_wrapper(prep_obs(list(zip(batch.state))), self.cuda_)
         next_state = cuda_wrapper(prep_obs(list(zip(batch.next_state))), self.cuda_)
         return (rewards, last_step, done, actions, state, next_state)
+
+    def unpack_alive_masks(self, batch):
+        '''
+        the alive masks of the states and the next states of a batch, shape = (b, n), or None if all agents are alive
+        '''
+        if not self.args.alive_mask or batch.alive_mask[0] is None:
+            return None, None
+        alive_mask = cuda_wrapper(torch.tensor(np.stack(batch.alive_mask), dtype=torch.float), self.cuda_)
+        next_alive_mask = cuda_wrapper(torch.tensor(np.stack(batch.next_alive_mask), dtype=torch.float), self.cuda_)
+        return alive_mask, next_alive_mask
@@ -1,8 +1,10 @@
+import math
 import torch
 import torch.nn as nn
 import numpy as np
 from utilities.util import *
 from models.model import Model
+from models.layers import MultiAgentLinear
 from collections import namedtuple
 
 
@@ -17,78 +19,41 @@ class SQDDPG(Model):
             self.target_net = target_net
             self.reload_params_to_target()
         self.sample_size = self.args.sample_size
-        self.Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state', 'done', 'last_step'))
+        self.shapley_mode = self.args.shapley_mode
+        if self.shapley_mode == 'exact':
+            self.coalition_slots, self.coalition_mask, self.shapley_weights = self.enumerate_coalitions()
+        self.pool_calls = 0
+        self.coalition_sampling = self.args.coalition_sampling
+        self.max_sample_size = self.args.max_sample_size if self.args.max_sample_size is not None else 4*self.args.sample_size
+        self.shapley_variance = None
+        self.Transition = namedtuple('Transition', ('state', 'action', 'reward', 'next_state', 'done', 'last_step', 'alive_mask', 'next_alive_mask'), defaults=(None, None))
 
     def unpack_data(self, batch):
         batch_size = len(batch.state)
         rewards = cuda_wrapper(torch.tensor(batch.reward, dtype=torch.float), self.cuda_)
-        last_step = cuda_wrapper(torch.tensor(batch.last_step, dtype=torch.float).contiguous().view(-1, 1), self.cuda_)
-        done = cuda_wrapper(torch.tensor(batch.done, dtype=torch.float).contiguous().view(-1, 1), self.cuda_)
+        # the envs with a done flag per agent store the number of agents that are done, so both flags are clamped to {0, 1}
+        last_step = cuda_wrapper((torch.tensor(batch.last_step, dtype=torch.float) > 0).float().contiguous().view(-1, 1), self.cuda_)
+        done = cuda_wrapper((torch.tensor(batch.done, dtype=torch.float) > 0).float().contiguous().view(-1, 1), self.cuda_)
         actions = cuda_wrapper(torch.tensor(np.stack(list(zip(*batch.action))[0], axis=0), dtype=torch.float), self.cuda_)
         state = cuda_wrapper(prep_obs(list(zip(batch.state))), self.cuda_)
         next_state = cuda_wrapper(prep_obs(list(zip(batch.next_state))), self.cuda_)
         return (rewards, last_step, done, actions, state, next_state)
 
-    def construct_policy_net(self):
-        action_dicts = []
-        if self.args.shared_parameters:
-            l1 = nn.Linear(self.obs_dim, self.hid_dim)
-            l2 = nn.Linear(self.hid_dim, self.hid_dim)
-            a = nn.Linear(self.hid_dim, self.act_dim)
-            for i in range(self.n_):
-                action_dicts.append(nn.ModuleDict( {'layer_1': l1,\
-                                                    'layer_2': l2,\
-                                                    'action_head': a
-                                                    }
-                                                 )
-                                   )
-        else:
-            for i in range(self.n_):
-                action_dicts.append(nn.ModuleDict( {'layer_1': nn.Linear(self.obs_dim, self.hid_dim),\
-                                                    'layer_2': nn.Linear(self.hid_dim, self.hid_dim),\
-                                                    'action_head': nn.Linear(self.hid_dim, self.act_dim)
-                                                    }
-                                                  )
-                                   )
-        self.action_dicts = nn.ModuleList(action_dicts)
-
     def construct_value_net(self):
-        value_dicts = []
-        if self.args.shared_parameters:
-            l1 = nn.Linear( (self.obs_dim+self.act_dim)*self.n_, self.hid_dim )
-            l2 = nn.Linear(self.hid_dim, self.hid_dim)
-            v = nn.Linear(self.hid_dim, 1)
-            for i in range(self.n_):
-                value_dicts.append(nn.ModuleDict( {'layer_1': l1,\
-                                                   'layer_2': l2,\
-                                                   'value_head': v
-                                                  }
-                                                )
-                                  )
-        else:
-            for i in range(self.n_):
-                value_dicts.append(nn.ModuleDict( {'layer_1': nn.Linear( (self.obs_dim+self.act_dim)*self.n_, self.hid_dim ),\
-                                                   'layer_2': nn.Linear(self.hid_dim, self.hid_dim),\
-                                                   'value_head': nn.Linear(self.hid_dim, 1)
-                                                  }
-                                                )
-                                  )
-        self.value_dicts = nn.ModuleList(value_dicts)
+        if self.args.critic_type == 'attention':
+            self.construct_attention_value_net(1)
+            return
+        shared = self.args.shared_parameters
+        self.value_dicts = nn.ModuleDict( {'layer_1': MultiAgentLinear(self.n_, (self.obs_dim+self.act_dim)*self.n_, self.hid_dim, shared),\
+                                           'layer_2': MultiAgentLinear(self.n_, self.hid_dim, self.hid_dim, shared),\
+                                           'value_head': MultiAgentLinear(self.n_, self.hid_dim, 1, shared)
+                                          }
+                                        )
 
     def construct_model(self):
         self.construct_value_net()
         self.construct_policy_net()
 
-    def policy(self, obs, schedule=None, last_act=None, last_hid=None, info={}, stat={}):
-        actions = []
-        for i in range(self.n_):
-            h = torch.relu( self.action_dicts[i]['layer_1'](obs[:, i, :]) )
-            h = torch.relu( self.action_dicts[i]['layer_2'](h) )
-            a = self.action_dicts[i]['action_head'](h)
-            actions.append(a)
-        actions = torch.stack(actions, dim=1)
-        return actions
-
     # def sample_grandcoalitions(self, batch_size):
     #     seq_set = cuda_wrapper(torch.tril(torch.ones(self.n_, self.n_), diagonal=0, out=None), self.cuda_)
     #     grand_coalitions = cuda_wrapper(torch.multinomial(torch.ones(batch_size*self.sample_size, self.n_)/self.n_, self.n_, replacement=False), self.cuda_)
@@ -98,7 +63,74 @@ class SQDDPG(Model):
     #     subcoalition_map = torch.matmul(individual_map, seq_set)
     #     grand_coalitions = grand_coalitions.unsqueeze(1).expand(batch_size*self.sample_size, self.n_, self.n_).contiguous().view(batch_size, self.sample_size, self.n_, self.n_) # shape = (b, n_s, n, n)
     #     return subcoalition_map, grand_coalitions
+    def refresh_permutation_pool(self):
+        '''
+        draw permutation_pool_size permutations with their inverse maps and subcoalition masks
+        '''
+        positions = cuda_wrapper(torch.rand(self.args.permutation_pool_size, self.n_).argsort(dim=-1), self.cuda_) # shape = (p, n), the position of every agent
+        self.pool_positions = positions
+        self.pool_grand_coalitions = positions.argsort(dim=-1) # shape = (p, n), the agent at every position
+        seq = cuda_wrapper(torch.arange(self.n_), self.cuda_)
+        self.pool_subcoalition_map = (seq.view(1, 1, -1) <= positions.unsqueeze(-1)).float() # shape = (p, n, n)
+
+    def pool_indices(self, rows):
+        if self.pool_calls%self.args.permutation_pool_refresh == 0:
+            self.refresh_permutation_pool()
+        self.pool_calls += 1
+        return cuda_wrapper(torch.randint(self.args.permutation_pool_size, (rows,)), self.cuda_)
+
+    def sample_pooled_grandcoalitions(self, batch_size):
+        indices = self.pool_indices(batch_size*self.sample_size)
+        subcoalition_map = self.pool_subcoalition_map[indices].contiguous().view(batch_size, self.sample_size, self.n_, self.n_)
+        grand_coalitions = self.pool_grand_coalitions[indices].unsqueeze(1).expand(batch_size*self.sample_size, \
+            self.n_, self.n_).contiguous().view(batch_size, self.sample_size, self.n_, self.n_) # shape = (b, n_s, n, n)
+        return subcoalition_map, grand_coalitions
+
+    def draw_permutations(self, rows):
+        '''
+        return the position of every agent and the agent at every position of random permutations, shape = (rows, n)
+        '''
+        if self.args.permutation_pool_size:
+            indices = self.pool_indices(rows)
+            return self.pool_positions[indices], self.pool_grand_coalitions[indices]
+        positions = cuda_wrapper(torch.rand(rows, self.n_).argsort(dim=-1), self.cuda_)
+        return positions, positions.argsort(dim=-1)
+
+    def sample_variance_reduced_grandcoalitions(self, batch_size):
+        '''
+        antithetic: the second half of the samples are the reversed permutations of the first half
+        stratified: every group of n samples shares a permutation shifted cyclically by evenly spaced offsets,
+        so that every agent meets the coalition sizes evenly
+        '''
+        n, sample_size = self.n_, self.sample_size
+        seq = cuda_wrapper(torch.arange(n), self.cuda_)
+        if self.coalition_sampling == 'antithetic':
+            half = (sample_size+1)//2
+            positions, grand_coalitions = self.draw_permutations(batch_size*half)
+            positions = positions.contiguous().view(batch_size, half, n)
+            grand_coalitions = grand_coalitions.contiguous().view(batch_size, half, n)
+            positions = torch.cat((positions, n-1-positions), dim=1)[:, :sample_size]
+            grand_coalitions = torch.cat((grand_coalitions, grand_coalitions.flip(-1)), dim=1)[:, :sample_size]
+        else:
+            groups = (sample_size+n-1)//n
+            positions, grand_coalitions = self.draw_permutations(batch_size*groups)
+            samples = cuda_wrapper(torch.arange(sample_size), self.cuda_)
+            group = samples//n
+            group_size = (sample_size - group*n).clamp(max=n)
+            offset = cuda_wrapper(torch.randint(n, (batch_size, groups)), self.cuda_)
+            shift = (offset[:, group] + (samples%n)*n//group_size) % n # shape = (b, n_s)
+            positions = (positions.contiguous().view(batch_size, groups, n)[:, group] + shift.unsqueeze(-1)) % n
+            # the agent at position k after the shift is the agent at position k-shift before
+            grand_coalitions = grand_coalitions.contiguous().view(batch_size, groups, n)[:, group].gather(-1, (seq.view(1, 1, -1) - shift.unsqueeze(-1)) % n)
+        subcoalition_map = (seq.view(1, 1, 1, -1) <= positions.unsqueeze(-1)).float() # shape = (b, n_s, n, n)
+        grand_coalitions = grand_coalitions.unsqueeze(2).expand(batch_size, sample_size, n, n) # shape = (b, n_s, n, n)
+        return subcoalition_map, grand_coalitions
+
     def sample_grandcoalitions(self, batch_size):
+        if self.coalition_sampling != 'random':
+            return self.sample_variance_reduced_grandcoalitions(batch_size)
+        if self.args.permutation_pool_size:
+            return self.sample_pooled_grandcoalitions(batch_size)
         seq_set = cuda_wrapper(torch.tril(torch.ones(self.n_, self.n_), diagonal=0, out=None), self.cuda_)
         grand_coalitions_pos = cuda_wrapper(torch.multinomial(torch.ones(batch_size*self.sample_size, self.n_)/self.n_, self.n_, replacement=False), self.cuda_) # shape = (b*n_s, n)
         individual_map = cuda_wrapper(torch.zeros(batch_size*self.sample_size*self.n_, self.n_), self.cuda_)
@@ -118,103 +150,229 @@ class SQDDPG(Model):
 
         return subcoalition_map, grand_coalitions
 
+    def coalition_values(self, obs, coalition_act):
+        '''
+        evaluate the critics of all agents on the masked actions of their coalitions,
+        obs shape = (b, n, o), coalition_act shape = (b, m, n, n*a) -> (b, m, n, 1)
+        '''
+        batch_size = obs.size(0)
+        # layer_1 is linear in the joint observation and the masked actions, so the observation part
+        # is shared by all coalitions and computed once per state
+        obs_features = slice(0, self.n_*self.obs_dim)
+        act_features = slice(self.n_*self.obs_dim, self.n_*(self.obs_dim+self.act_dim))
+        h_obs = self.value_dicts['layer_1'].forward_shared_input(obs.contiguous().view(batch_size, -1), features=obs_features) # shape = (b, n, h)
+        h_act = self.value_dicts['layer_1'](coalition_act, features=act_features, bias=False) # shape = (b, m, n, h)
+        h = torch.relu( h_obs.unsqueeze(1) + h_act )
+        h = torch.relu( self.value_dicts['layer_2'](h) )
+        values = self.value_dicts['value_head'](h)
+        return values
+
+    def unique_coalition_values(self, obs, act, subcoalition_map, grand_coalitions):
+        '''
+        evaluate every distinct (state, critic, ordered coalition) input once and scatter the values back to the samples,
+        the distinct inputs of every critic are padded to the same count so that the critics stay batched
+        '''
+        # the actions may hold several joint actions per state, obs shape = (b, n, o), act shape = (k*b, n, a)
+        batch_size, sample_size, n = act.size(0), subcoalition_map.size(1), self.n_
+        groups = 1 if self.args.shared_parameters else n
+        # the agent in every slot of the coalition, or n for an empty slot
+        codes = torch.where(subcoalition_map > 0, grand_coalitions, torch.full_like(grand_coalitions, n)) # shape = (b, n_s, n, n)
+        critic = cuda_wrapper(torch.arange(n) if groups > 1 else torch.zeros(n, dtype=torch.long), self.cuda_).view(1, 1, n, 1).expand(batch_size, sample_size, n, 1)
+        state = cuda_wrapper(torch.arange(batch_size), self.cuda_).view(-1, 1, 1, 1).expand(batch_size, sample_size, n, 1)
+        keys = torch.cat((critic, state, codes), dim=-1).contiguous().view(-1, n+2)
+        if groups * batch_size * (n+1)**n < 2**63:
+            # pack every row into one integer, the critic is the most significant digit so the sorted keys are grouped by critic
+            radix = cuda_wrapper((n+1)**torch.arange(n, dtype=torch.long), self.cuda_)
+            packed = (keys[:, 0]*batch_size + keys[:, 1]) * (n+1)**n + (keys[:, 2:]*radix).sum(dim=-1)
+            unique_packed, inverse = torch.unique(packed, return_inverse=True)
+            first = cuda_wrapper(torch.zeros(unique_packed.size(0), dtype=torch.long), self.cuda_)
+            first.scatter_(0, inverse, cuda_wrapper(torch.arange(keys.size(0)), self.cuda_))
+            unique = keys[first]
+        else:
+            unique, inverse = torch.unique(keys, dim=0, return_inverse=True) # the rows are sorted by critic first
+        counts = torch.bincount(unique[:, 0], minlength=groups)
+        rank = cuda_wrapper(torch.arange(unique.size(0)), self.cuda_) - (torch.cumsum(counts, dim=0) - counts)[unique[:, 0]]
+        padded = counts.max().item()
+        slots = cuda_wrapper(torch.full((padded, groups, n), n, dtype=torch.long), self.cuda_)
+        slots[rank, unique[:, 0]] = unique[:, 2:]
+        states = cuda_wrapper(torch.zeros((padded, groups), dtype=torch.long), self.cuda_)
+        states[rank, unique[:, 0]] = unique[:, 1]
+        # the extra zero action fills the empty slots
+        act = torch.cat((act, torch.zeros_like(act[:, :1])), dim=1) # shape = (b, n+1, a)
+        coalition_act = act[states.unsqueeze(-1).expand(padded, groups, n), slots].contiguous().view(padded, groups, -1) # shape = (u, g, n*a)
+        obs_features = slice(0, n*self.obs_dim)
+        act_features = slice(n*self.obs_dim, n*(self.obs_dim+self.act_dim))
+        h_obs = self.value_dicts['layer_1'].forward_shared_input(obs.contiguous().view(obs.size(0), -1), features=obs_features) # shape = (b, n, h)
+        h_obs = h_obs[states%obs.size(0), cuda_wrapper(torch.arange(groups), self.cuda_).unsqueeze(0)] # shape = (u, g, h)
+        h_act = self.value_dicts['layer_1'](coalition_act, features=act_features, bias=False) # shape = (u, g, h)
+        h = torch.relu( h_obs + h_act )
+        h = torch.relu( self.value_dicts['layer_2'](h) )
+        values = self.value_dicts['value_head'](h)[rank, unique[:, 0]] # shape = (unique, 1)
+        self.loss_stat['coalition_dedup_ratio'] = 1 - unique.size(0) / keys.size(0)
+        return values[inverse].contiguous().view(batch_size, sample_size, n, 1)
+
     def marginal_contribution(self, obs, act):
+        '''
+        act shape = (b, n, a) -> (b, n_s, n, 1), or (k, b, n, a) -> (k, b, n_s, n, 1) for k joint actions that are
+        evaluated on the same states and the same sampled coalitions in one critic pass
+        '''
         batch_size = obs.size(0)
+        single = act.dim() == 3
+        act = act.unsqueeze(0) if single else act
+        k = act.size(0)
         subcoalition_map, grand_coalitions = self.sample_grandcoalitions(batch_size) # shape = (b, n_s, n, n)
-        grand_coalitions = grand_coalitions.unsqueeze(-1).expand(batch_size, self.sample_size, self.n_, self.n_, self.act_dim) # shape = (b, n_s, n, n, a)
-        act = act.unsqueeze(1).unsqueeze(2).expand(batch_size, self.sample_size, self.n_, self.n_, self.act_dim).gather(3, grand_coalitions) # shape = (b, n, a) -> (b, 1, 1, n, a) -> (b, n_s, n, n, a)
-        act_map = subcoalition_map.unsqueeze(-1).float() # shape = (b, n_s, n, n, 1)
-        act = act * act_map
-        act = act.contiguous().view(batch_size, self.sample_size, self.n_, -1) # shape = (b, n_s, n, n*a)
-        obs = obs.unsqueeze(1).unsqueeze(2).expand(batch_size, self.sample_size, self.n_, self.n_, self.obs_dim) # shape = (b, n, o) -> (b, 1, n, o) -> (b, 1, 1, n, o) -> (b, n_s, n, n, o)
-        obs = obs.contiguous().view(batch_size, self.sample_size, self.n_, self.n_*self.obs_dim) # shape = (b, n_s, n, n, o) -> (b, n_s, n, n*o)
-        inp = torch.cat((obs, act), dim=-1)
-        values = []
-        for i in range(self.n_):
-            h = torch.relu( self.value_dicts[i]['layer_1'](inp[:, :, i, :]) )
-            h = torch.relu( self.value_dicts[i]['layer_2'](h) )
-            v = self.value_dicts[i]['value_head'](h)
-            values.append(v)
-        values = torch.stack(values, dim=2)
-        return values
+        sample_size = subcoalition_map.size(1)
+        if self.args.critic_type == 'attention':
+            # the attention critic takes the members of the coalitions in the order of the agents
+            member = torch.zeros_like(subcoalition_map).scatter_add_(-1, grand_coalitions, subcoalition_map) # shape = (b, n_s, n, n)
+            values = self.attention_value(obs, act.transpose(0, 1), member).transpose(0, 1) # shape = (k, b, n_s, n, 1)
+        elif self.args.dedup_coalitions:
+            values = self.unique_coalition_values(obs, act.contiguous().view(k*batch_size, self.n_, self.act_dim), subcoalition_map.repeat(k, 1, 1, 1), grand_coalitions.repeat(k, 1, 1, 1))
+            values = values.contiguous().view(k, batch_size, sample_size, self.n_, 1)
+        else:
+            grand_coalitions = grand_coalitions.unsqueeze(1).unsqueeze(-1).expand(batch_size, k, sample_size, self.n_, self.n_, self.act_dim) # shape = (b, k, n_s, n, n, a)
+            act = act.transpose(0, 1).unsqueeze(2).unsqueeze(3).expand(batch_size, k, sample_size, self.n_, self.n_, self.act_dim).gather(4, grand_coalitions) # shape = (k, b, n, a) -> (b, k, 1, 1, n, a) -> (b, k, n_s, n, n, a)
+            act_map = subcoalition_map.unsqueeze(1).unsqueeze(-1).float() # shape = (b, 1, n_s, n, n, 1)
+            act = act * act_map
+            act = act.contiguous().view(batch_size, k*sample_size, self.n_, -1) # shape = (b, k*n_s, n, n*a)
+            values = self.coalition_values(obs, act).contiguous().view(batch_size, k, sample_size, self.n_, 1).transpose(0, 1)
+        return values[0] if single else values
+
+    def enumerate_coalitions(self):
+        '''
+        list the 2^(n-1) coalitions of the other agents for every agent, the members fill the slots in ascending order
+        followed by the agent itself, and the shapley weight of a coalition of size s is s!(n-s-1)!/n!
+        '''
+        others_num = self.n_ - 1
+        slots, mask, weights = [], [], []
+        for code in range(2**others_num):
+            slots.append([])
+            mask.append([])
+            weights.append([])
+            for i in range(self.n_):
+                others = [j for j in range(self.n_) if j != i]
+                members = [others[k] for k in range(others_num) if code >> k & 1]
+                size = len(members)
+                slots[-1].append(members + [i] + [0]*(others_num-size))
+                mask[-1].append([1]*(size+1) + [0]*(others_num-size))
+                weights[-1].append(math.factorial(size)*math.factorial(others_num-size)/math.factorial(self.n_))
+        slots = cuda_wrapper(torch.tensor(slots, dtype=torch.long), self.cuda_) # shape = (2^(n-1), n, n)
+        mask = cuda_wrapper(torch.tensor(mask, dtype=torch.float).unsqueeze(-1), self.cuda_) # shape = (2^(n-1), n, n, 1)
+        weights = cuda_wrapper(torch.tensor(weights, dtype=torch.float), self.cuda_) # shape = (2^(n-1), n)
+        return slots, mask, weights
+
+    def exact_marginal_contribution(self, obs, act):
+        '''
+        act shape = (b, n, a) -> (b, 2^(n-1), n, 1), or (k, b, n, a) -> (k, b, 2^(n-1), n, 1)
+        '''
+        batch_size = obs.size(0)
+        single = act.dim() == 3
+        act = act.unsqueeze(0) if single else act
+        k = act.size(0)
+        coalitions_num = self.coalition_slots.size(0)
+        if self.args.critic_type == 'attention':
+            member = torch.zeros_like(self.coalition_mask.squeeze(-1)).scatter_add_(-1, self.coalition_slots, self.coalition_mask.squeeze(-1)) # shape = (2^(n-1), n, n)
+            values = self.attention_value(obs, act.transpose(0, 1), member.unsqueeze(0)).transpose(0, 1) # shape = (k, b, 2^(n-1), n, 1)
+            return values[0] if single else values
+        act = act[:, :, self.coalition_slots] * self.coalition_mask # shape = (k, b, n, a) -> (k, b, 2^(n-1), n, n, a)
+        act = act.transpose(0, 1).contiguous().view(batch_size, k*coalitions_num, self.n_, -1) # shape = (b, k*2^(n-1), n, n*a)
+        values = self.coalition_values(obs, act).contiguous().view(batch_size, k, coalitions_num, self.n_, 1).transpose(0, 1)
+        return values[0] if single else values
+
+    def track_shapley_variance(self, values):
+        '''
+        keep a moving average of the variance of one monte carlo sample of the shapley values and adapt
+        sample_size to target_std_error, values shape = (b, n_s, n)
+        '''
+        sample_size = values.size(1)
+        if self.coalition_sampling == 'antithetic':
+            # the reversed pairs are correlated, so the variance is measured over the pair means
+            half = sample_size//2
+            values = (values[:, :half] + values[:, half:2*half]) / 2
+            scale = 2
+        else:
+            scale = 1
+        if values.size(1) < 2:
+            return
+        variance = scale * values.detach().var(dim=1).mean(dim=0) # shape = (n,)
+        if self.shapley_variance is None:
+            self.shapley_variance = variance
+        else:
+            self.shapley_variance = 0.9 * self.shapley_variance + 0.1 * variance
+        self.loss_stat['shapley_std_error'] = (self.shapley_variance / sample_size).sqrt().mean().item()
+        if self.args.target_std_error is not None:
+            sample_size = int(math.ceil(self.shapley_variance.max().item() / self.args.target_std_error**2))
+            self.sample_size = min(max(sample_size, 2), self.max_sample_size)
+            if self.args.target:
+                self.target_net.sample_size = self.sample_size
+        self.loss_stat['sample_size'] = self.sample_size
+
+    def shapley_values(self, obs, act, track=False):
+        '''
+        estimate the shapley values of all agents, act shape = (b, n, a) -> (b, n) or (k, b, n, a) -> (k, b, n)
+        '''
+        if self.shapley_mode == 'exact':
+            values = self.exact_marginal_contribution(obs, act).squeeze(-1) # shape = (..., b, 2^(n-1), n)
+            return (values * self.shapley_weights).sum(dim=-2)
+        values = self.marginal_contribution(obs, act).squeeze(-1) # shape = (..., b, n_s, n)
+        if track:
+            self.track_shapley_variance(values if act.dim() == 3 else values[0])
+        return values.mean(dim=-2)
+
+    def alive_shapley_sum(self, shapley_values, alive_mask=None):
+        '''
+        the sum of the shapley values of the alive agents, shape = (b, n) -> (b, n)
+        '''
+        if alive_mask is not None:
+            shapley_values = shapley_values * alive_mask
+        return shapley_values.sum(dim=-1, keepdim=True).expand_as(shapley_values)
+
+    def target_next_values(self, next_state, next_alive_mask=None):
+        '''
+        the sum of the shapley values of the target networks under the argmax action of the target policy
+        '''
+        next_action_out = self.target_net.policy(next_state, info={'alive_mask': next_alive_mask})
+        next_actions_ = select_action(self.args, next_action_out, status='train', exploration=False)
+        if next_alive_mask is not None:
+            next_actions_ = next_actions_ * next_alive_mask.unsqueeze(-1)
+        return self.alive_shapley_sum(self.target_net.shapley_values(next_state, next_actions_), next_alive_mask)
 
     def get_loss(self, batch):
         batch_size = len(batch.state)
         n = self.args.agent_num
         action_dim = self.args.action_dim
         rewards, last_step, done, actions, state, next_state = self.unpack_data(batch)
+        alive_mask, next_alive_mask = self.unpack_alive_masks(batch)
         # do torche argmax action on torche action loss
-        action_out = self.policy(state)
+        action_out = self.policy(state, info={'alive_mask': alive_mask})
         actions_ = select_action(self.args, action_out, status='train', exploration=False)
-        shapley_values = self.marginal_contribution(state, actions_).mean(dim=1).contiguous().view(-1, n)
-        # do torche exploration action on torche value loss
-        shapley_values_sum = self.marginal_contribution(state, actions).mean(dim=1).contiguous().view(-1, n).sum(dim=-1, keepdim=True).expand(batch_size, self.n_)
+        joint_actions = torch.stack((actions_, actions), dim=0)
+        if alive_mask is not None:
+            # the dead agents add no action to the coalitions, so the critics are only masked and not packed
+            joint_actions = joint_actions * alive_mask.unsqueeze(-1)
+        # do torche exploration action on torche value loss, both share one critic pass and one coalition sample
+        shapley_values, shapley_values_ = self.shapley_values(state, joint_actions, track=True)
+        # the loss of agent i only trains the critic of agent i, as with one critic optimizer per agent, so the shapley values of
+        # the other agents enter it as constants and the trainer can take one backward of the summed losses
+        shapley_values_sum = self.alive_shapley_sum(shapley_values_.detach(), alive_mask) + shapley_values_ - shapley_values_.detach()
         # do torche argmax action on torche next value loss
-        if self.args.target:
-            next_action_out = self.target_net.policy(next_state)
-        else:
-            next_action_out = self.policy(next_state)
-        next_actions_ = select_action(self.args, next_action_out, status='train', exploration=False)
-        if self.args.target:
-            next_shapley_values_sum = self.target_net.marginal_contribution(next_state, next_actions_.detach()).mean(dim=1).contiguous().view(-1, n).sum(dim=-1, keepdim=True).expand(batch_size, self.n_)
-        else:
-            next_shapley_values_sum = self.marginal_contribution(next_state, next_actions_.detach()).mean(dim=1).contiguous().view(-1, n).sum(dim=-1, keepdim=True).expand(batch_size, self.n_)
-        returns = cuda_wrapper(torch.zeros((batch_size, n), dtype=torch.float), self.cuda_)
+        with torch.no_grad():
+            if self.args.target:
+                next_shapley_values_sum = self.target_values(next_state, self.target_next_values, next_alive_mask)
+            else:
+                next_action_out = self.policy(next_state, info={'alive_mask': next_alive_mask})
+                next_actions_ = select_action(self.args, next_action_out, status='train', exploration=False)
+                if next_alive_mask is not None:
+                    next_actions_ = next_actions_ * next_alive_mask.unsqueeze(-1)
+                next_shapley_values_sum = self.alive_shapley_sum(self.shapley_values(next_state, next_actions_), next_alive_mask)
         assert shapley_values_sum.size() == next_shapley_values_sum.size()
+        returns = td_target(rewards, last_step, done, next_shapley_values_sum, self.args.gamma)
         assert returns.size() == shapley_values_sum.size()
-        for i in reversed(range(rewards.size(0))):
-            if last_step[i]:
-                next_return = 0 if done[i] else next_shapley_values_sum[i].detach()
-            else:
-                next_return = next_shapley_values_sum[i].detach()
-            returns[i] = rewards[i] + self.args.gamma * next_return
         deltas = returns - shapley_values_sum
         advantages = shapley_values
         if self.args.normalize_advantages:
             advantages = batchnorm(advantages)
         action_loss = -advantages
-        action_loss = action_loss.mean(dim=0)
-        value_loss = deltas.pow(2).mean(dim=0)
+        action_loss = masked_mean(action_loss, alive_mask)
+        value_loss = masked_mean(deltas.pow(2), alive_mask)
         return action_loss, value_loss, action_out
-
-    def train_process(self, stat, trainer):
-        info = {}
-        state = trainer.env.reset()
-        if self.args.reward_record_type is 'episode_mean_step':
-            trainer.mean_reward = 0
-            trainer.mean_success = 0
-        for t in range(self.args.max_steps):
-            state_ = cuda_wrapper(prep_obs(state).contiguous().view(1, self.n_, self.obs_dim), self.cuda_)
-            start_step = True if t == 0 else False
-            state_ = cuda_wrapper(prep_obs(state).contiguous().view(1, self.n_, self.obs_dim), self.cuda_)
-            action_out = self.policy(state_, info=info, stat=stat)
-            action = select_action(self.args, action_out, status='train', info=info)
-            _, actual = translate_action(self.args, action, trainer.env)
-            next_state, reward, done, debug = trainer.env.step(actual)
-            if isinstance(done, list): done = np.sum(done)
-            done_ = done or t==self.args.max_steps-1
-            trans = self.Transition(state,
-                                    action.cpu().numpy(),
-                                    np.array(reward),
-                                    next_state,
-                                    done,
-                                    done_
-                                   )
-            self.transition_update(trainer, trans, stat)
-            success = debug['success'] if 'success' in debug else 0.0
-            trainer.steps += 1
-            if self.args.reward_record_type is 'mean_step':
-                trainer.mean_reward = trainer.mean_reward + 1/trainer.steps*(np.mean(reward) - trainer.mean_reward)
-                trainer.mean_success = trainer.mean_success + 1/trainer.steps*(success - trainer.mean_success)
-            elif self.args.reward_record_type is 'episode_mean_step':
-                trainer.mean_reward = trainer.mean_reward + 1/(t+1)*(np.mean(reward) - trainer.mean_reward)
-                trainer.mean_success = trainer.mean_success + 1/(t+1)*(success - trainer.mean_success)
-            else:
-                raise RuntimeError('Please enter a correct reward record type, e.g. mean_step or episode_mean_step.')
-            stat['mean_reward'] = trainer.mean_reward
-            stat['mean_success'] = trainer.mean_success
-            if done_:
-                break
-            state = next_state
-        stat['turn'] = t+1
-        trainer.episodes += 1
@@ -1,42 +1,69 @@
+import argparse
+import importlib.util
+import random
+import sys
+
+
+
+parser = argparse.ArgumentParser(description='Test rl agent.')
+parser.add_argument('--save-path', type=str, nargs='?', default='./', help='Please input the directory of saving model.')
+parser.add_argument('--arguments', type=str, default=None, help='Please input the argument file to use instead of ./arguments.py.')
+parser.add_argument('--eval-episodes', type=int, default=0, help='Please input the number of episodes to evaluate every saved model in the background (0 disables it).')
+parser.add_argument('--eval-interval', type=float, default=10, help='Please input the seconds between two checks for a new saved model.')
+parser.add_argument('--local_rank', '--local-rank', type=int, default=0, help='Set by torch.distributed.launch, the rank is read from RANK instead.')
+argv = parser.parse_args()
+
+# register the argument file under the module name imported by the trainer, so concurrent runs never share a file
+if argv.arguments is not None:
+    spec = importlib.util.spec_from_file_location('arguments', argv.arguments)
+    sys.modules['arguments'] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules['arguments'])
+
 import numpy as np
 from utilities.trainer import *
+from utilities.actor_learner import ActorLearnerTrainer
+from utilities.evaluator import Evaluator
+from utilities.data_parallel import DataParallelPGTrainer
+from utilities.async_learner import AsyncPGTrainer
 import torch
 from arguments import *
 import os
 from utilities.util import *
 from utilities.logger import Logger
-import argparse
 
 
 
-parser = argparse.ArgumentParser(description='Test rl agent.')
-parser.add_argument('--save-path', type=str, nargs='?', default='./', help='Please input the directory of saving model.')
-argv = parser.parse_args()
-
-
+if args.seed is not None:
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
 
 if argv.save_path[-1] is '/':
     save_path = argv.save_path
 else:
     save_path = argv.save_path+'/'
 
+# only the first learner writes to disk under the data parallel mode
+rank = int(os.environ.get('RANK', 0)) if args.data_parallel else 0
+
 # create save folders
-if 'model_save' not in os.listdir(save_path):
-    os.mkdir(save_path+'model_save')
-if 'tensorboard' not in os.listdir(save_path):
-    os.mkdir(save_path+'tensorboard')
-if log_name not in os.listdir(save_path+'model_save/'):
-    os.mkdir(save_path+'model_save/'+log_name)
-if log_name not in os.listdir(save_path+'tensorboard/'):
-    os.mkdir(save_path+'tensorboard/'+log_name)
-else:
-    path = save_path+'tensorboard/'+log_name
-    for f in os.listdir(path):
-        file_path = os.path.join(path,f)
-        if os.path.isfile(file_path):
-            os.remove(file_path)
+if rank == 0:
+    if 'model_save' not in os.listdir(save_path):
+        os.mkdir(save_path+'model_save')
+    if 'tensorboard' not in os.listdir(save_path):
+        os.mkdir(save_path+'tensorboard')
+    if log_name not in os.listdir(save_path+'model_save/'):
+        os.mkdir(save_path+'model_save/'+log_name)
+    if log_name not in os.listdir(save_path+'tensorboard/'):
+        os.mkdir(save_path+'tensorboard/'+log_name)
+    else:
+        path = save_path+'tensorboard/'+log_name
+        for f in os.listdir(path):
+            file_path = os.path.join(path,f)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
 
-logger = Logger(save_path+'tensorboard/' + log_name)
+logger = Logger(save_path+'tensorboard/' + log_name) if rank == 0 else None
 
 model = Model[model_name]
 
@@ -44,22 +71,46 @@ strategy = Strategy[model_name]
 
 print ( '{}\n'.format(args) )
 
-if strategy == 'pg':
+if strategy == 'pg' and args.data_parallel:
+    train = DataParallelPGTrainer(args, model, env(), logger, args.online, log_name)
+elif strategy == 'pg' and args.async_learner:
+    train = AsyncPGTrainer(args, model, env(), logger, args.online)
+elif strategy == 'pg' and args.actor_num > 0:
+    train = ActorLearnerTrainer(args, model, env(), logger, args.online)
+elif strategy == 'pg':
     train = PGTrainer(args, model, env(), logger, args.online)
 elif strategy == 'q':
     raise NotImplementedError('This needs to be implemented.')
 else:
     raise RuntimeError('Please input the correct strategy, e.g. pg or q.')
 
+thread_info = 'num_threads: {}, num_interop_threads: {}, calibration: {}'.format(train.num_threads, torch.get_num_interop_threads(), train.thread_timings)
+print ( '{}\n'.format(thread_info) )
+
+model_path = save_path+'model_save/'+log_name+'/model.pt'
+
+if argv.eval_episodes > 0 and rank == 0:
+    evaluator = Evaluator(args, model, env(), model_path, save_path+'tensorboard/'+log_name, argv.eval_episodes, argv.eval_interval)
+
 stat = dict()
 
-for i in range(args.train_episodes_num):
+while train.episodes < args.train_episodes_num:
+    last_episodes = train.episodes
     train.run(stat)
+    if rank != 0:
+        continue
     train.logging(stat)
-    if i%args.save_model_freq == args.save_model_freq-1:
+    if train.episodes//args.save_model_freq > last_episodes//args.save_model_freq:
         train.print_info(stat)
-        torch.save({'model_state_dict': train.behaviour_net.state_dict()}, save_path+'model_save/'+log_name+'/model.pt')
+        # write then rename so that the evaluator never reads a partial checkpoint
+        torch.save({'model_state_dict': train.behaviour_net.state_dict(), 'episodes': train.episodes}, model_path+'.tmp')
+        os.replace(model_path+'.tmp', model_path)
         print ('The model is saved!\n')
         with open(save_path+'model_save/'+log_name +'/log.txt', 'w+') as file:
             file.write(str(args)+'\n')
-            file.write(str(i))
+            file.write(thread_info+'\n')
+            file.write(str(train.episodes-1))
+
+train.close()
+if argv.eval_episodes > 0 and rank == 0:
+    evaluator.close()
@@ -0,0 +1,123 @@
+import copy
+from queue import Empty
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from utilities.util import *
+from utilities.trainer import PGTrainer
+
+
+
+def rollout_worker(args, model, env, shared_net, version, queue, stop, seed):
+    '''
+    run episodes on a cpu copy of the policy and stream the transitions to the learner
+    '''
+    torch.set_num_threads(1)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    policy_net = model(args)
+    policy_version = -1
+    n = args.agent_num
+    # flush the transitions at the update cadence of the learner
+    chunk = max(1, args.behaviour_update_freq)
+    trans = []
+    state = env.reset()
+    alive_mask = initial_alive_mask(env, n)
+    t, mean_reward, mean_success = 0, 0, 0
+    while not stop.is_set():
+        if version.value != policy_version:
+            with version.get_lock():
+                policy_net.action_dicts.load_state_dict(shared_net.action_dicts.state_dict())
+                policy_version = version.value
+        with torch.no_grad():
+            state_ = prep_obs(state).contiguous().view(1, n, args.obs_size)
+            action_out = policy_net.policy(state_, info={'alive_mask': alive_mask[None]})
+            action = select_action(args, action_out, status='train')
+        _, actual = translate_action(args, action, env)
+        next_state, reward, done, debug = env.step(actual)
+        if isinstance(done, list): done = np.sum(done)
+        done_ = done or t==args.max_steps-1
+        next_alive_mask = debug['alive_mask'] if 'alive_mask' in debug else np.ones(n)
+        trans.append((state, action.numpy(), np.array(reward), next_state, done, done_, alive_mask, next_alive_mask))
+        success = debug['success'] if 'success' in debug else 0.0
+        mean_reward = mean_reward + 1/(t+1)*(np.mean(reward) - mean_reward)
+        mean_success = mean_success + 1/(t+1)*(success - mean_success)
+        if done_:
+            queue.put((trans, (mean_reward, mean_success, t+1)))
+            trans = []
+            state = env.reset()
+            alive_mask = initial_alive_mask(env, n)
+            t, mean_reward, mean_success = 0, 0, 0
+        else:
+            if len(trans) >= chunk:
+                queue.put((trans, None))
+                trans = []
+            state, alive_mask = next_state, next_alive_mask
+            t += 1
+
+
+
+class ActorLearnerTrainer(PGTrainer):
+    '''
+    the experience is collected by actor_num worker processes and the learner only runs the updates of PGTrainer,
+    the policy weights are broadcast to the workers through shared memory every weight_sync_freq policy updates
+    '''
+
+    def __init__(self, args, model, env, logger, online):
+        super(ActorLearnerTrainer, self).__init__(args, model, env, logger, online)
+        # fork keeps the environments and the argument module without pickling them
+        ctx = mp.get_context('fork')
+        worker_args = self.args._replace(cuda=False)
+        self.shared_net = model(worker_args)
+        self.shared_net.action_dicts.load_state_dict(self.behaviour_net.action_dicts.state_dict())
+        self.shared_net.share_memory()
+        self.version = ctx.Value('i', 0)
+        self.queue = ctx.Queue(maxsize=4*self.args.actor_num)
+        self.stop = ctx.Event()
+        self.policy_updates = 0
+        seed = np.random.randint(2**31 - self.args.actor_num)
+        self.workers = []
+        for i in range(self.args.actor_num):
+            worker = ctx.Process(target=rollout_worker, args=(worker_args, model, copy.deepcopy(env), self.shared_net, self.version, self.queue, self.stop, seed+i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def broadcast_policy(self):
+        with self.version.get_lock():
+            self.shared_net.action_dicts.load_state_dict(self.behaviour_net.action_dicts.state_dict())
+            self.version.value += 1
+
+    def action_replay_process(self, stat):
+        super(ActorLearnerTrainer, self).action_replay_process(stat)
+        self.policy_updates += 1
+        if self.policy_updates%self.args.weight_sync_freq == 0:
+            self.broadcast_policy()
+
+    def run(self, stat):
+        episode_rewards, episode_successes, episode_turns = [], [], []
+        while not episode_turns:
+            trans, episode = self.queue.get()
+            trans = [self.behaviour_net.Transition(*tran) for tran in trans]
+            self.transition_update(trans, stat)
+            if episode is not None:
+                episode_rewards.append(episode[0])
+                episode_successes.append(episode[1])
+                episode_turns.append(episode[2])
+                self.episodes += 1
+        stat['mean_reward'] = np.mean(episode_rewards)
+        stat['mean_success'] = np.mean(episode_successes)
+        stat['turn'] = np.mean(episode_turns)
+        stat['policy_version'] = self.version.value
+        self.entr += self.entr_inc
+
+    def close(self):
+        self.stop.set()
+        for worker in self.workers:
+            # drain the queue so that no worker stays blocked on a full queue
+            while worker.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except Empty:
+                    pass
+                worker.join(timeout=0.1)
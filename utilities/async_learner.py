@@ -0,0 +1,112 @@
+import threading
+import numpy as np
+import torch
+from utilities.util import *
+from utilities.trainer import PGTrainer
+
+
+
+class AsyncPGTrainer(PGTrainer):
+    '''
+    the updates run on a learner thread at update_to_data_ratio policy updates per environment step,
+    while the rollout keeps stepping the environments with a policy copy synced every weight_sync_freq updates
+    '''
+
+    def __init__(self, args, model, env, logger, online):
+        super(AsyncPGTrainer, self).__init__(args, model, env, logger, online)
+        self.rollout_net = model(self.args).cuda() if self.cuda_ else model(self.args)
+        self.rollout_net.action_dicts.load_state_dict(self.behaviour_net.action_dicts.state_dict())
+        if self.args.update_to_data_ratio is None:
+            self.update_to_data_ratio = 1 / self.args.behaviour_update_freq
+        else:
+            self.update_to_data_ratio = self.args.update_to_data_ratio
+        # buffer_lock guards the replay buffer, param_lock the policy parameters during a step or a sync
+        self.buffer_lock = threading.Lock()
+        self.param_lock = threading.Lock()
+        self.stat_lock = threading.Lock()
+        self.new_data = threading.Event()
+        self.stop = threading.Event()
+        self.learner_stat = dict()
+        self.learner_error = None
+        self.updates = 0
+        self.target_updates = 0
+        self.policy_version = 0
+        self.rollout_version = 0
+        self.policy_lags = []
+        self.start_steps = None
+        self.learner = threading.Thread(target=self.learner_loop)
+        self.learner.daemon = True
+        self.learner.start()
+
+    def sample_batch(self):
+        with self.buffer_lock:
+            batch = self.draw_batch()
+        return self.behaviour_net.Transition(*zip(*batch))
+
+    def learner_ready(self):
+        with self.buffer_lock:
+            return self.steps>self.args.replay_warmup and len(self.replay_buffer.buffer)>=self.args.batch_size
+
+    def learner_update(self):
+        stat = dict()
+        for _ in range(self.args.critic_update_times):
+            self.value_replay_process(stat)
+        with self.param_lock:
+            self.action_replay_process(stat)
+            self.policy_version += 1
+        self.updates += 1
+        # keep the target cadence of target_update_freq environment steps
+        if self.args.target and self.steps//self.args.target_update_freq > self.target_updates:
+            self.target_updates = self.steps//self.args.target_update_freq
+            self.behaviour_net.update_target()
+        with self.stat_lock:
+            self.learner_stat.update(stat)
+
+    def learner_loop(self):
+        try:
+            while not self.stop.is_set():
+                if self.start_steps is None:
+                    if self.learner_ready():
+                        self.start_steps = self.steps
+                    else:
+                        self.new_data.wait(0.01)
+                        self.new_data.clear()
+                        continue
+                if self.updates < self.update_to_data_ratio * (self.steps - self.start_steps):
+                    self.learner_update()
+                else:
+                    self.new_data.wait(0.01)
+                    self.new_data.clear()
+        except Exception as e:
+            self.learner_error = e
+
+    def sync_policy(self):
+        with self.param_lock:
+            self.rollout_net.action_dicts.load_state_dict(self.behaviour_net.action_dicts.state_dict())
+            self.rollout_version = self.policy_version
+
+    def transition_update(self, trans, stat):
+        with self.buffer_lock:
+            self.replay_buffer.add_experiences(trans)
+        self.steps += len(trans)
+        self.policy_lags.append(self.policy_version - self.rollout_version)
+        if self.policy_version - self.rollout_version >= self.args.weight_sync_freq:
+            self.sync_policy()
+        self.new_data.set()
+
+    def run(self, stat):
+        steps, updates = self.steps, self.updates
+        with torch.no_grad():
+            self.rollout_net.train_process(stat, self)
+        if self.learner_error is not None:
+            raise self.learner_error
+        with self.stat_lock:
+            stat.update(self.learner_stat)
+        stat['update_to_data_ratio'] = (self.updates - updates) / max(self.steps - steps, 1)
+        stat['policy_lag'] = np.mean(self.policy_lags)
+        self.policy_lags = []
+        self.entr += self.entr_inc
+
+    def close(self):
+        self.stop.set()
+        self.learner.join()
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from utilities.trainer import PGTrainer
+
+
+
+def init_distributed(log_name):
+    '''
+    join the process group given by RANK/WORLD_SIZE, the rendezvous is MASTER_ADDR/MASTER_PORT
+    if they are set (e.g. by torchrun) or a local file otherwise, which is returned to be removed at the end,
+    the file is unique to the process for a single learner and to RENDEZVOUS_ID for the learners of one launch
+    '''
+    rank = int(os.environ.get('RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rendezvous = None
+    if not dist.is_initialized():
+        if 'MASTER_ADDR' in os.environ:
+            init_method = 'env://'
+        else:
+            launch_id = os.environ.get('RENDEZVOUS_ID', str(os.getpid()) if world_size == 1 else None)
+            assert launch_id is not None, 'Please set RENDEZVOUS_ID to a unique id of the launch, or MASTER_ADDR/MASTER_PORT.'
+            rendezvous = os.path.join(tempfile.gettempdir(), '{}.{}.rendezvous'.format(log_name, launch_id))
+            init_method = 'file://' + rendezvous
+        dist.init_process_group(backend='gloo', init_method=init_method, rank=rank, world_size=world_size)
+    return rank, world_size, rendezvous
+
+
+
+class DataParallelPGTrainer(PGTrainer):
+    '''
+    every learner process collects into its own replay buffer and averages the gradients of the
+    per-agent optimizers with one all-reduce before each step, so the parameters stay identical
+    '''
+
+    def __init__(self, args, model, env, logger, online, log_name):
+        self.rank, self.world_size, self.rendezvous = init_distributed(log_name)
+        super(DataParallelPGTrainer, self).__init__(args, model, env, logger, online)
+        for param in self.behaviour_net.parameters():
+            dist.broadcast(param.data, 0)
+        if self.args.target:
+            self.behaviour_net.reload_params_to_target()
+        # decorrelate the exploration and the replay sampling of the learners
+        seed = self.args.seed if self.args.seed is not None else torch.initial_seed()
+        torch.manual_seed(seed + self.rank)
+        if self.args.seed is not None:
+            np.random.seed((seed + self.rank) % 2**32)
+
+    def reduce_grads(self, grads):
+        flat_grads = [g for grad in grads for g in grad]
+        flat = _flatten_dense_tensors(flat_grads)
+        dist.all_reduce(flat)
+        flat /= self.world_size
+        for g, reduced in zip(flat_grads, _unflatten_dense_tensors(flat, flat_grads)):
+            g.copy_(reduced)
+
+    def run(self, stat):
+        # a fixed number of steps per call keeps the collectives of all learners aligned
+        episodes = self.episodes
+        self.behaviour_net.train_process(stat, self, steps=self.args.max_steps)
+        finished = torch.tensor([float(self.episodes - episodes)])
+        dist.all_reduce(finished)
+        self.episodes = episodes + int(finished.item())
+        self.entr += self.entr_inc
+
+    def close(self):
+        # every learner has left the rendezvous before its file is removed
+        dist.barrier()
+        dist.destroy_process_group()
+        if self.rank == 0 and self.rendezvous is not None and os.path.exists(self.rendezvous):
+            os.remove(self.rendezvous)
@@ -0,0 +1,58 @@
+import os
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from utilities.tester import PGTester
+from utilities.logger import Logger
+
+
+
+def evaluate_worker(args, model, env, model_path, log_dir, episodes, interval, stop):
+    '''
+    evaluate every new checkpoint written to model_path and log the results to the tensorboard run of the training
+    '''
+    torch.set_num_threads(1)
+    logger = Logger(log_dir)
+    if args.target:
+        behaviour_net = model(args, model(args))
+    else:
+        behaviour_net = model(args)
+    tester = PGTester(env, behaviour_net, args, verbose=False)
+    last_mtime = None
+    while True:
+        # evaluate the pending checkpoint once more after the training is stopped
+        stopped = stop.is_set()
+        mtime = os.path.getmtime(model_path) if os.path.isfile(model_path) else None
+        if mtime is not None and mtime != last_mtime:
+            last_mtime = mtime
+            checkpoint = torch.load(model_path, map_location='cpu')
+            behaviour_net.load_state_dict(checkpoint['model_state_dict'])
+            with torch.no_grad():
+                tester.run_game(episodes=episodes, render=False)
+            step = checkpoint.get('episodes', 0)
+            logger.scalar_summary('eval_mean_reward', np.mean(tester.all_reward), step)
+            logger.scalar_summary('eval_mean_success', np.mean(tester.all_success), step)
+            logger.scalar_summary('eval_turn', np.mean(tester.all_turn), step)
+            logger.writer.flush()
+        if stopped:
+            break
+        time.sleep(interval)
+
+
+
+class Evaluator(object):
+    '''
+    run PGTester on the fresh checkpoints in a separate cpu process with a single thread
+    '''
+
+    def __init__(self, args, model, env, model_path, log_dir, episodes, interval=10):
+        ctx = mp.get_context('fork')
+        self.stop = ctx.Event()
+        self.process = ctx.Process(target=evaluate_worker, args=(args._replace(cuda=False), model, env, model_path, log_dir, episodes, interval, self.stop))
+        self.process.daemon = True
+        self.process.start()
+
+    def close(self):
+        self.stop.set()
+        self.process.join()
@@ -3,6 +3,37 @@ import numpy as np
 
 
 def inspector(args):
+    if args.async_learner:
+        # the learner thread samples the replay buffer, so the on-policy models that clear it are excluded
+        assert args.replay is True
+        assert args.online is True
+        assert args.model_name not in ['coma_fc', 'independent_ac', 'mfac']
+    if args.n_step > 1 or args.gae_lambda is not None:
+        # only the on-policy models keep just the latest rollout, whose steps are interleaved over the env_num copies
+        assert args.model_name in ['coma_fc', 'independent_ac', 'mfac']
+        assert args.actor_num == 0
+        assert args.batch_size % args.env_num == 0
+    if args.target_cache:
+        # the on-policy models clear the replay buffer after every update, so nothing would be reused
+        assert args.replay is True
+        assert args.online is True
+        assert args.target is True
+        assert args.model_name not in ['coma_fc', 'independent_ac', 'mfac']
+    if args.agent_id_embedding:
+        assert args.shared_parameters is True
+    if args.alive_mask:
+        # the slot of a car that leaves may be taken by a new car within the n steps
+        assert args.n_step == 1
+        assert args.gae_lambda is None
+    if args.gae_lambda is not None:
+        # the lambda-returns take the place of the n-step returns
+        assert args.n_step == 1
+    assert args.critic_type in ['mlp', 'attention']
+    if args.critic_type == 'attention':
+        assert args.model_name in ['maddpg', 'sqddpg', 'coma_fc']
+        assert args.hid_size % args.attention_heads == 0
+        # the deduplication of the coalitions relies on the first layer of the mlp critics
+        assert not getattr(args, 'dedup_coalitions', False)
     if args.model_name is 'maddpg':
         assert args.replay is True
         assert args.q_func is True
@@ -32,6 +63,13 @@ def inspector(args):
         assert args.epsilon_softmax is False
         assert args.online is True
         assert hasattr(args, 'sample_size')
+        assert args.shapley_mode in ['sample', 'exact']
+        # the exact mode enumerates the 2^(n-1) coalitions of every agent, shape = (b, 2^(n-1), n)
+        assert args.shapley_mode != 'exact' or args.agent_num <= 10
+        # the mlp critics depend on the order of the members in their slots, which the sampled permutations randomize,
+        # so only the attention critic that sees the members in the order of the agents has an exact counterpart
+        assert args.shapley_mode != 'exact' or args.critic_type == 'attention'
+        assert args.coalition_sampling in ['random', 'antithetic', 'stratified']
     elif args.model_name is 'coma_fc':
         assert args.replay is True
         assert args.q_func is True
@@ -40,5 +78,13 @@ def inspector(args):
         assert args.continuous is False
         assert args.gumbel_softmax is False
         assert args.epsilon_softmax is False
+    elif args.model_name is 'mfac':
+        assert args.replay is True
+        assert args.q_func is True
+        assert args.target is True
+        assert args.online is True
+        assert args.continuous is False
+        assert args.gumbel_softmax is False
+        assert args.epsilon_softmax is False
     else:
         raise NotImplementedError('The model is not added!')
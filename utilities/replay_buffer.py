@@ -1,32 +1,101 @@
 import numpy as np
+import torch
 
 
 class TransReplayBuffer(object):
+    '''
+    a ring of transitions, the slot of a transition stays fixed until it is overwritten and
+    every transition gets a unique id, so that the values computed for a slot can be cached
+    '''
 
     def __init__(self, size):
-        self.size = size
+        self.size = int(size)
         self.buffer = []
+        self.position = 0
+        self.count = 0
+        self.ids = np.zeros(self.size, dtype=np.int64)
 
     def get_single(self, index):
         return self.buffer[index]
 
-    def offset(self):
-        self.buffer.pop(0)
-
     def get_batch(self, batch_size):
         length = len(self.buffer)
         indices = np.random.choice(length, batch_size, replace=False)
         batch_buffer = [self.buffer[i] for i in indices]
         return batch_buffer
 
+    def get_batch_with_keys(self, batch_size):
+        '''
+        the batch together with the keys (slots, ids) of its transitions
+        '''
+        length = len(self.buffer)
+        indices = np.random.choice(length, batch_size, replace=False)
+        batch_buffer = [self.buffer[i] for i in indices]
+        return batch_buffer, (torch.from_numpy(indices), torch.from_numpy(self.ids[indices]))
+
+    def get_recent(self, batch_size):
+        '''
+        the latest batch_size transitions in the order of collection
+        '''
+        if batch_size <= self.position:
+            return self.buffer[self.position-batch_size:self.position]
+        return self.buffer[len(self.buffer)-batch_size+self.position:] + self.buffer[:self.position]
+
     def add_experience(self, trans):
-        est_len = 1 + len(self.buffer)
-        if est_len > self.size:
-            self.offset()
-        self.buffer.append(trans)
+        self.add_experiences([trans])
+
+    def add_experiences(self, trans):
+        for tran in trans:
+            if len(self.buffer) < self.size:
+                self.buffer.append(tran)
+            else:
+                self.buffer[self.position] = tran
+            self.ids[self.position] = self.count
+            self.position = (self.position + 1) % self.size
+            self.count += 1
 
     def clear(self):
+        # the ids keep counting, so the cached values of the old transitions never match the new ones
         self.buffer = []
+        self.position = 0
+
+
+
+class TargetValueCache(object):
+    '''
+    the target next state values of the replay slots, stamped with the id of the transition and the version of the target network
+    '''
+
+    def __init__(self, size):
+        self.size = int(size)
+        self.values = None
+        self.ids = torch.full((self.size,), -1, dtype=torch.long)
+        self.versions = torch.full((self.size,), -1, dtype=torch.long)
+        self.hits = 0
+        self.queries = 0
+
+    def get(self, keys, version, inputs, compute):
+        '''
+        look up the values of the batch keys, the stale or missing entries are computed in one batch by compute(*inputs[missing]),
+        the inputs that are None are passed on as they are
+        '''
+        slots, ids = keys
+        hit = (self.ids[slots] == ids) & (self.versions[slots] == version)
+        missing = (~hit).nonzero().view(-1)
+        if missing.numel() > 0:
+            with torch.no_grad():
+                values = compute(*[None if x is None else x[missing.to(x.device)] for x in inputs])
+            if self.values is None:
+                self.values = values.new_zeros((self.size,)+values.size()[1:])
+            self.values[slots[missing].to(values.device)] = values
+            self.ids[slots[missing]] = ids[missing]
+            self.versions[slots[missing]] = version
+        self.hits += hit.sum().item()
+        self.queries += slots.numel()
+        return self.values[slots.to(self.values.device)]
+
+    def hit_rate(self):
+        return self.hits / max(self.queries, 1)
 
 
 
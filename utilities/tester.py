@@ -9,8 +9,9 @@ import sys
 
 class PGTester(object):
 
-    def __init__(self, env, behaviour_net, args):
+    def __init__(self, env, behaviour_net, args, verbose=True):
         self.env = env
+        self.verbose = verbose
         self.behaviour_net = behaviour_net.cuda().eval() if args.cuda else behaviour_net.eval()
         self.args = args
         self.cuda_ = self.args.cuda and torch.cuda.is_available()
@@ -28,10 +29,11 @@ class PGTester(object):
         _, actual = translate_action(self.args, action, self.env)
         next_state, reward, done, debug  = self.env.step(actual)
         success = debug['success'] if 'success' in debug else 0.0
-        disp = 'The rewards of agents are:'
-        for r in reward:
-            disp += ' '+str(r)[:7]
-        print (disp+'.')
+        if self.verbose:
+            disp = 'The rewards of agents are:'
+            for r in reward:
+                disp += ' '+str(r)[:7]
+            print (disp+'.')
         return next_state, action, done, reward, success
 
     def run_game(self, episodes, render):
@@ -55,7 +57,8 @@ class PGTester(object):
         self.all_turn = []
         self.all_success = [] # special for traffic junction
         for ep in range(episodes):
-            print ('The episode {} starts!'.format(ep))
+            if self.verbose:
+                print ('The episode {} starts!'.format(ep))
             episode_reward = []
             episode_success = []
             state = self.env.reset()
@@ -71,7 +74,8 @@ class PGTester(object):
                 if render:
                     time.sleep(0.01)
                 if np.all(done) or t==self.args.max_steps-1:
-                    print ('The episode {} is finished!'.format(ep))
+                    if self.verbose:
+                        print ('The episode {} is finished!'.format(ep))
                     self.all_reward.append(np.mean(episode_reward))
                     self.all_success.append(np.mean(episode_success))
                     self.all_turn.append(t+1)
@@ -0,0 +1,102 @@
+import copy
+import os
+import time
+import numpy as np
+import torch
+from utilities.util import *
+
+
+
+def candidate_threads():
+    '''
+    define the thread counts to try, i.e. powers of two up to the usable cores
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    candidates = []
+    num = 1
+    while num < cores:
+        candidates.append(num)
+        num *= 2
+    candidates.append(cores)
+    return candidates
+
+def dummy_batch(args, behaviour_net):
+    '''
+    build a replay batch of the training shape filled with random observations and actions
+    '''
+    n = args.agent_num
+    trans = []
+    for _ in range(args.batch_size):
+        state = np.random.rand(n, args.obs_size)
+        next_state = np.random.rand(n, args.obs_size)
+        action = np.eye(args.action_dim)[np.random.randint(args.action_dim, size=n)][np.newaxis]
+        reward = np.random.rand(n)
+        trans.append(behaviour_net.Transition(state, action, reward, next_state, 0, 0))
+    return behaviour_net.Transition(*zip(*trans))
+
+def benchmark_threads(args, behaviour_net, num_threads, iterations=3, warmup=1):
+    '''
+    measure the mean time of one rollout step plus one forward/backward on a replay batch
+    '''
+    torch.set_num_threads(num_threads)
+    cuda = torch.cuda.is_available() and args.cuda
+    batch = dummy_batch(args, behaviour_net)
+    obs = cuda_wrapper(torch.randn(1, args.agent_num, args.obs_size), cuda)
+    for i in range(warmup+iterations):
+        if i == warmup:
+            start = time.time()
+        with torch.no_grad():
+            behaviour_net.policy(obs)
+        action_loss, value_loss, _ = behaviour_net.get_loss(batch)
+        (action_loss.sum() + value_loss.sum()).backward()
+        behaviour_net.zero_grad()
+    return (time.time() - start) / iterations
+
+def calibrate_threads(args, behaviour_net, candidates=None):
+    '''
+    pick the fastest intra-op thread count for the model, the timings are returned for the run log, a copy of the model
+    is timed under a forked random state so that the training starts from the same state and random numbers
+    '''
+    if candidates is None:
+        candidates = candidate_threads()
+    if len(candidates) == 1:
+        torch.set_num_threads(candidates[0])
+        return candidates[0], dict()
+    timings = dict()
+    np_state = np.random.get_state()
+    with torch.random.fork_rng(devices=[]):
+        net = copy.deepcopy(behaviour_net)
+        for num_threads in candidates:
+            timings[num_threads] = benchmark_threads(args, net, num_threads)
+    np.random.set_state(np_state)
+    best = min(timings, key=timings.get)
+    torch.set_num_threads(best)
+    return best, timings
+
+def set_interop_threads(num_threads):
+    '''
+    the inter-op pool can only be sized before its first use, later calls are ignored
+    '''
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError:
+        pass
+
+def configure_threads(args, behaviour_net):
+    '''
+    set the intra-op threads either from the arguments or by calibration
+    '''
+    if args.num_interop_threads is not None:
+        set_interop_threads(args.num_interop_threads)
+    elif not (torch.cuda.is_available() and args.cuda):
+        # the models never run ops concurrently so a larger inter-op pool only oversubscribes
+        set_interop_threads(1)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+        return args.num_threads, dict()
+    if torch.cuda.is_available() and args.cuda:
+        return torch.get_num_threads(), dict()
+    return calibrate_threads(args, behaviour_net)
@@ -1,4 +1,5 @@
 from collections import namedtuple
+import copy
 import numpy as np
 import torch
 from torch import optim
@@ -6,6 +7,7 @@ import torch.nn as nn
 from utilities.util import *
 from utilities.replay_buffer import *
 from utilities.inspector import *
+from utilities.thread_tuner import configure_threads
 from arguments import *
 from utilities.logger import Logger
 
@@ -29,13 +31,18 @@ class PGTrainer(object):
                 self.replay_buffer = TransReplayBuffer(int(self.args.replay_buffer_size))
             else:
                 self.replay_buffer = EpisodeReplayBuffer(int(self.args.replay_buffer_size))
+        if self.args.target_cache:
+            self.behaviour_net.target_cache = TargetValueCache(int(self.args.replay_buffer_size))
         self.env = env
-        self.action_optimizers = []
-        for action_dict in self.behaviour_net.action_dicts:
-            self.action_optimizers.append(optim.Adam(action_dict.parameters(), lr=args.policy_lrate))
-        self.value_optimizers = []
-        for value_dict in self.behaviour_net.value_dicts:
-            self.value_optimizers.append(optim.Adam(value_dict.parameters(), lr=args.value_lrate))
+        # the rollout workers of the actor-learner mode step their own copies, so the learner keeps only env
+        self.envs = [env] + [copy.deepcopy(env) for _ in range(self.args.env_num-1 if self.args.actor_num == 0 else 0)]
+        self.states = None
+        self.env_steps = np.zeros(self.args.env_num, dtype=int)
+        self.episode_rewards = np.zeros(self.args.env_num)
+        self.episode_successes = np.zeros(self.args.env_num)
+        # the policies of all agents are stacked, each agent only writes the gradient of its own slice
+        self.action_optimizer = optim.Adam(self.behaviour_net.action_dicts.parameters(), lr=args.policy_lrate)
+        self.value_optimizer = optim.Adam(self.behaviour_net.value_dicts.parameters(), lr=args.value_lrate)
         self.init_action = cuda_wrapper( torch.zeros(1, self.args.agent_num, self.args.action_dim), cuda=self.cuda_ )
         self.steps = 0
         self.episodes = 0
@@ -43,89 +50,110 @@ class PGTrainer(object):
         self.mean_success = 0
         self.entr = self.args.entr
         self.entr_inc = self.args.entr_inc
+        self.num_threads, self.thread_timings = configure_threads(self.args, self.behaviour_net)
 
     def get_loss(self, batch):
         action_loss, value_loss, log_p_a = self.behaviour_net.get_loss(batch)
         return action_loss, value_loss, log_p_a
 
-    def action_compute_grad(self, stat, loss, retain_graph):
+    def action_compute_grad(self, stat, loss, params, retain_graph):
         action_loss, log_p_a = loss
         if not self.args.continuous:
             if self.entr > 0:
                 entropy = multinomial_entropy(log_p_a)
                 action_loss -= self.entr * entropy
                 stat['entropy'] = entropy.item()
-        action_loss.backward(retain_graph=retain_graph)
+        return torch.autograd.grad(action_loss, params, retain_graph=retain_graph, allow_unused=True)
 
-    def value_compute_grad(self, value_loss, retain_graph):
-        value_loss.backward(retain_graph=retain_graph)
+    def value_compute_grad(self, value_loss, params):
+        return torch.autograd.grad(value_loss, params, allow_unused=True)
+
+    def reduce_grads(self, grads):
+        '''
+        hook to combine the per-agent gradients across learner processes before the optimizer steps
+        '''
+        pass
 
     def grad_clip(self, params):
         for param in params:
             param.grad.data.clamp_(-1, 1)
 
+    def draw_batch(self):
+        '''
+        draw the transitions of an update from the replay buffer
+        '''
+        # the multi-step returns need the transitions in the order of collection
+        if self.args.n_step > 1 or self.args.gae_lambda is not None:
+            return self.replay_buffer.get_recent(self.args.batch_size)
+        if self.args.target_cache:
+            batch, self.behaviour_net.batch_keys = self.replay_buffer.get_batch_with_keys(self.args.batch_size)
+            return batch
+        return self.replay_buffer.get_batch(self.args.batch_size)
+
+    def sample_batch(self):
+        batch = self.draw_batch()
+        return self.behaviour_net.Transition(*zip(*batch))
+
     def action_replay_process(self, stat):
-        batch = self.replay_buffer.get_batch(self.args.batch_size)
-        batch = self.behaviour_net.Transition(*zip(*batch))
+        batch = self.sample_batch()
         self.action_transition_process(stat, batch)
 
     def value_replay_process(self, stat):
-        batch = self.replay_buffer.get_batch(self.args.batch_size)
-        batch = self.behaviour_net.Transition(*zip(*batch))
+        batch = self.sample_batch()
         self.value_transition_process(stat, batch)
 
+    def transition_update(self, trans, stat):
+        self.behaviour_net.transition_update(self, trans, stat)
+
     def action_transition_process(self, stat, trans):
         action_loss, value_loss, log_p_a = self.get_loss(trans)
-        policy_grads = []
-        for i in range(self.args.agent_num):
-            retain_graph = False if i == self.args.agent_num-1 else True
-            action_optimizer = self.action_optimizers[i]
-            action_optimizer.zero_grad()
-            self.action_compute_grad(stat, (action_loss[i], log_p_a[:, i, :]), retain_graph)
-            grad = []
-            for pp in action_optimizer.param_groups[0]['params']:
-                grad.append(pp.grad.clone())
-            policy_grads.append(grad)
-        policy_grad_norms = []
-        for action_optimizer, grad in zip(self.action_optimizers, policy_grads):
-            param = action_optimizer.param_groups[0]['params']
-            for i in range(len(param)):
-                param[i].grad = grad[i]
-            if self.args.grad_clip:
-                self.grad_clip(param)
-            policy_grad_norms.append(get_grad_norm(param))
-            action_optimizer.step()
-        stat['policy_grad_norm'] = np.array(policy_grad_norms).mean()
+        stat.update(self.behaviour_net.loss_stat)
+        n = self.args.agent_num
+        param = self.action_optimizer.param_groups[0]['params']
+        policy_grad = [torch.zeros_like(pp) for pp in param]
+        for i in range(n):
+            retain_graph = False if i == n-1 else True
+            grads = self.action_compute_grad(stat, (action_loss[i], log_p_a[:, i, :]), param, retain_graph)
+            for g, grad in zip(policy_grad, grads):
+                if grad is None:
+                    continue
+                # the shared parameters accumulate the gradients of all agents
+                if g.size(0) == n:
+                    g[i] += grad[i]
+                else:
+                    g += grad
+        self.reduce_grads([policy_grad])
+        for i in range(len(param)):
+            param[i].grad = policy_grad[i]
+        if self.args.grad_clip:
+            self.grad_clip(param)
+        stat['policy_grad_norm'] = get_agent_grad_norm(param, n)
+        self.action_optimizer.step()
         stat['action_loss'] = action_loss.mean().item()
 
     def value_transition_process(self, stat, trans):
         action_loss, value_loss, log_p_a = self.get_loss(trans)
-        value_grads = []
-        for i in range(self.args.agent_num):
-            retain_graph = False if i == self.args.agent_num-1 else True
-            value_optimizer = self.value_optimizers[i]
-            value_optimizer.zero_grad()
-            self.value_compute_grad(value_loss[i], retain_graph)
-            grad = []
-            for pp in value_optimizer.param_groups[0]['params']:
-                grad.append(pp.grad.clone())
-            value_grads.append(grad)
-        value_grad_norms = []
-        for value_optimizer, grad in zip(self.value_optimizers, value_grads):
-            param = value_optimizer.param_groups[0]['params']
-            for i in range(len(param)):
-                param[i].grad = grad[i]
-            if self.args.grad_clip:
-                self.grad_clip(param)
-            value_grad_norms.append(get_grad_norm(param))
-            value_optimizer.step()
-        stat['value_grad_norm'] = np.array(value_grad_norms).mean()
+        stat.update(self.behaviour_net.loss_stat)
+        param = self.value_optimizer.param_groups[0]['params']
+        # every critic sits in its own slice of the stacked parameters, so one backward of the summed losses
+        # gives the gradients of all agents at once
+        value_grad = [torch.zeros_like(pp) if grad is None else grad for pp, grad in zip(param, self.value_compute_grad(value_loss.sum(), param))]
+        self.reduce_grads([value_grad])
+        for i in range(len(param)):
+            param[i].grad = value_grad[i]
+        if self.args.grad_clip:
+            self.grad_clip(param)
+        stat['value_grad_norm'] = get_agent_grad_norm(param, self.args.agent_num)
+        self.value_optimizer.step()
         stat['value_loss'] = value_loss.mean().item()
 
     def run(self, stat):
         self.behaviour_net.train_process(stat, self)
         self.entr += self.entr_inc
 
+    def close(self):
+        pass
+
     def logging(self, stat):
         for tag, value in stat.items():
             if isinstance(value, np.ndarray):
@@ -94,6 +94,16 @@ def translate_action(args, action, env):
             cp_actions[i] = 0.5 * (cp_actions[i] + 1.0) * (high - low) + low
         return actions, cp_actions
 
+def translate_actions(args, action, envs):
+    '''
+    translate the batched actions of shape (env_num, n, action_dim) into the inputs of each environment
+    '''
+    if not args.continuous:
+        actions = action.detach().cpu().numpy()
+        return [list(actions[i]) for i in range(len(envs))]
+    else:
+        return [translate_action(args, action[i:i+1], env)[1] for i, env in enumerate(envs)]
+
 def prep_obs(state=[]):
     state = np.array(state)
     if len(state.shape) == 2:
@@ -123,6 +133,16 @@ def get_grad_norm(params):
         grad_norms.append(torch.norm(param.grad).item())
     return np.mean(grad_norms)
 
+def get_agent_grad_norm(params, agent_num):
+    '''
+    the mean over agents and parameters of the gradient norms, the parameters are stacked along the agent dimension
+    '''
+    grad_norms = []
+    for param in params:
+        grad = param.grad.contiguous().view(param.size(0), -1)
+        grad_norms.append(torch.norm(grad, dim=-1).expand(agent_num))
+    return torch.stack(grad_norms).mean().item()
+
 def merge_dict(stat, key, value):
     if key in stat.keys():
         stat[key] += value
@@ -135,31 +155,92 @@ def unpack_data(args, batch):
     action_dim = args.action_dim
     cuda = torch.cuda.is_available() and args.cuda
     rewards = cuda_wrapper(torch.tensor(batch.reward, dtype=torch.float), cuda)
-    last_step = cuda_wrapper(torch.tensor(batch.last_step, dtype=torch.float).contiguous().view(-1, 1), cuda)
-    done = cuda_wrapper(torch.tensor(batch.done, dtype=torch.float).contiguous().view(-1, 1), cuda)
+    # the envs with a done flag per agent store the number of agents that are done, so both flags are clamped to {0, 1}
+    last_step = cuda_wrapper((torch.tensor(batch.last_step, dtype=torch.float) > 0).float().contiguous().view(-1, 1), cuda)
+    done = cuda_wrapper((torch.tensor(batch.done, dtype=torch.float) > 0).float().contiguous().view(-1, 1), cuda)
     actions = cuda_wrapper(torch.tensor(np.stack(list(zip(*batch.action))[0], axis=0), dtype=torch.float), cuda)
     last_actions = cuda_wrapper(torch.tensor(np.stack(list(zip(*batch.last_action))[0], axis=0), dtype=torch.float), cuda)
     state = cuda_wrapper(prep_obs(list(zip(batch.state))), cuda)
     next_state = cuda_wrapper(prep_obs(list(zip(batch.next_state))), cuda)
     return (rewards, last_step, done, actions, last_actions, state, next_state)
 
-def n_step(rewards, last_step, done, next_values, n_step, args):
-    cuda = torch.cuda.is_available() and args.cuda
-    returns = cuda_wrapper(torch.zeros_like(rewards), cuda=cuda)
-    i = rewards.size(0)-1
-    while i >= 0:
-        if last_step[i]:
-            next_return = 0 if done[i] else next_values[i].detach()
-            for j in reversed(range(i-n_step+1, i+1)):
-                returns[j] = rewards[j] + args.gamma * next_return
-                next_return = returns[j]
-            i -= n_step
-            continue
-        else:
-            next_return = next_values[i+n_step-1].detach()
-        for j in reversed(range(n_step)):
-            g = rewards[i+j] + args.gamma * next_return
-            next_return = g
-        returns[i] = g.detach()
-        i -= 1
-    return returns
+def td_target(rewards, last_step, done, next_values, gamma):
+    '''
+    the one-step returns of a batch, the next value is dropped at the last step of the episodes that are done
+    rewards, next_values shape = (b, n), last_step, done shape = (b, 1), done may count the agents that are done
+    '''
+    return rewards + gamma * (1 - (last_step * done > 0).float()) * next_values.detach()
+
+def masked_mean(x, mask=None):
+    '''
+    the mean over the batch of the entries of the alive agents, x, mask shape = (b, n) -> (n,), mask is None if all agents are alive
+    '''
+    if mask is None:
+        return x.mean(dim=0)
+    return (x * mask).sum(dim=0) / mask.sum(dim=0).clamp(min=1)
+
+def initial_alive_mask(env, agent_num):
+    '''
+    the alive mask of the state returned by env.reset(), all agents are alive unless the environment tracks them
+    '''
+    alive_mask = getattr(env, 'alive_mask', None)
+    return np.ones(agent_num) if alive_mask is None else np.copy(alive_mask)
+
+def shift_up(x, shift):
+    '''
+    x[t] <- x[t+shift] along the first dimension, the last shift rows are zero
+    '''
+    return torch.cat((x[shift:], torch.zeros_like(x[:shift])), dim=0)
+
+def discounted_cumsum(x, discounts):
+    '''
+    the reverse scan y[t] = x[t] + discounts[t] * y[t+1] along the time dimension of x shape = (T, ...),
+    computed by recursive doubling in ceil(log2(T)) vectorized steps, the scan stops at the end of the batch
+    '''
+    y, a = x, discounts.expand_as(x)
+    shift = 1
+    while shift < x.size(0):
+        y = y + a * shift_up(y, shift)
+        a = a * shift_up(a, shift)
+        shift *= 2
+    return y
+
+def n_step_returns(rewards, last_step, done, next_values, gamma, n_step):
+    '''
+    the n-step returns of time-major batches, rewards, next_values shape = (T, ..., n), last_step, done shape = (T, ..., 1),
+    the returns are truncated at the last step of the episodes (bootstrapped unless done) and at the end of the batch
+    '''
+    next_values = next_values.detach()
+    end = torch.zeros_like(last_step)
+    end[-1] = 1
+    end = torch.max(end, last_step)
+    # the returns until the end of the episodes or of the batch, the next value is only added where the scan stops
+    returns = discounted_cumsum(rewards + gamma * end * (1 - last_step * done) * next_values, gamma * (1 - end))
+    # the discount of the window t, ..., t+n_step-1, zero if the window reaches an end
+    discounts = gamma * (1 - end)
+    window = discounts
+    for k in range(1, n_step):
+        window = window * shift_up(discounts, k)
+    # G[t] = R[t] - gamma^n * R[t+n] + gamma^n * V(s[t+n])
+    return returns - window * (shift_up(returns, n_step) - shift_up(next_values, n_step-1))
+
+def gae(rewards, last_step, done, values, next_values, gamma, lam):
+    '''
+    the generalized advantage estimation of time-major batches, values, next_values shape = (T, ..., n),
+    the sum of the discounted td errors is cut at the last step of the episodes and at the end of the batch
+    '''
+    deltas = td_target(rewards, last_step, done, next_values, gamma) - values.detach()
+    return discounted_cumsum(deltas, gamma * lam * (1 - last_step))
+
+def compute_returns(args, rewards, last_step, done, values, next_values):
+    '''
+    the targets of the values, shape = (b, n), the lambda-returns if gae_lambda is set, the n-step returns if n_step > 1
+    or the one-step td targets otherwise, the multi-step targets need the latest steps of the env_num copies in the order of collection
+    '''
+    if args.gae_lambda is None and args.n_step == 1:
+        return td_target(rewards, last_step, done, next_values, args.gamma)
+    time_major = lambda x: x.contiguous().view(-1, args.env_num, x.size(-1))
+    if args.gae_lambda is not None:
+        advantages = gae(*map(time_major, (rewards, last_step, done, values, next_values)), args.gamma, args.gae_lambda)
+        return advantages.contiguous().view_as(values) + values.detach()
+    return n_step_returns(*map(time_major, (rewards, last_step, done, next_values)), args.gamma, args.n_step).contiguous().view_as(values)